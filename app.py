@@ -1,27 +1,182 @@
-import geopandas as gpd
-import folium
+import click
+import csv
+import gzip
+import hashlib
+import importlib
+import json
+import math
 import os
+import re
 import secrets
-
-from flask import Flask, render_template, request, url_for, redirect, flash
+import shutil
+import socket
+import threading
+import time
+import uuid
+
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from io import StringIO
+from urllib.parse import quote_plus
+from flask import (Flask, Response, render_template, request, url_for, redirect, flash, jsonify, stream_template, g,
+                   has_request_context, stream_with_context)
+from flask.cli import AppGroup
 from flask_sqlalchemy import SQLAlchemy
 from geoalchemy2 import Geometry
-from sqlalchemy import text
+from geoalchemy2.elements import WKTElement
+from sqlalchemy import event, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.orm import load_only, selectinload
+from sqlalchemy.pool import NullPool
 from werkzeug.utils import secure_filename
-from shapely import wkb
+
+# brotli is only used for the brotli encoded copy of the saved map, browsers are sent gzip without it
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# a module imported the first time one of its attributes is used. optional modules that are not installed load as
+# None, which available() reports
+class LazyModule:
+    def __init__(self, name, optional=False):
+        self.name = name
+        self.optional = optional
+        self.loaded = False
+        self.module = None
+
+    def load(self):
+        if not self.loaded:
+            try:
+                self.module = importlib.import_module(self.name)
+            except ImportError:
+                if not self.optional:
+                    raise
+            self.loaded = True
+        return self.module
+
+    def available(self):
+        return self.load() is not None
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+
+# the geo stack (pandas, pyproj, gdal through pyogrio, folium) costs every worker time at boot and memory, while the
+# record, search and crud routes never use it (the edit page only reads a point with shapely, which geoalchemy2
+# imports anyway). it is imported by the imports, the full map, the nearby lookups and the exports on first use
+gpd = LazyModule("geopandas")
+pd = LazyModule("pandas")
+np = LazyModule("numpy")
+shapely = LazyModule("shapely")
+folium = LazyModule("folium")
+
+# pyogrio reads a slice of a shapefile without parsing the rest of it, geopandas' own reader is used without it
+pyogrio = LazyModule("pyogrio", optional=True)
+
+# pyarrow is only needed for geoparquet exports
+pa = LazyModule("pyarrow", optional=True)
+pq = LazyModule("pyarrow.parquet", optional=True)
+
+
+# true for 1, true, yes or on in an environment variable
+def env_flag(name, default=False):
+    value = os.environ.get(name)
+    return default if value is None else value.strip().lower() in ("1", "true", "yes", "on")
+
 
 app = Flask(__name__)
 app.secret_key = secrets.token_hex(16)
-app.config['SQLALCHEMY_DATABASE_URI'] = ('postgresql+psycopg2://'
-                                         'pycrum_user:'
-                                         'pOCwAVVMw3YDbjPfMKkHSyZpK9JGicR3@'
-                                         'dpg-ckrvo87d47qs73f05310-a.ohio-postgres.render.com/'
-                                         'pycrum')
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('PYCRUM_DATABASE_URI',
+                                                       ('postgresql+psycopg2://'
+                                                        'pycrum_user:'
+                                                        'pOCwAVVMw3YDbjPfMKkHSyZpK9JGicR3@'
+                                                        'dpg-ckrvo87d47qs73f05310-a.ohio-postgres.render.com/'
+                                                        'pycrum'))
+
+# every gunicorn worker holds up to PYCRUM_DB_POOL_SIZE + PYCRUM_DB_MAX_OVERFLOW connections, so size them to the
+# worker count and the database's connection limit. behind pgbouncer in transaction pooling mode (PYCRUM_PGBOUNCER)
+# pgbouncer does the pooling and the workers keep no connections of their own
+app.config['PGBOUNCER'] = env_flag('PYCRUM_PGBOUNCER')
+app.config['DB_STATEMENT_TIMEOUT_MS'] = int(os.environ.get('PYCRUM_DB_STATEMENT_TIMEOUT_MS', 0))
+if app.config['PGBOUNCER']:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {"poolclass": NullPool}
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        "pool_size": int(os.environ.get('PYCRUM_DB_POOL_SIZE', 5)),
+        "max_overflow": int(os.environ.get('PYCRUM_DB_MAX_OVERFLOW', 5)),
+        "pool_timeout": int(os.environ.get('PYCRUM_DB_POOL_TIMEOUT', 30)),
+        "pool_recycle": int(os.environ.get('PYCRUM_DB_POOL_RECYCLE', 1800)),
+        "pool_pre_ping": env_flag('PYCRUM_DB_PRE_PING', True),
+    }
 app.config['TEMPLATES_AUTO_RELOAD'] = True
 app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['MAX_CONTENT_LENGTH'] = 512 * 1024 * 1024
+app.config['UPLOAD_TTL'] = 3600
+app.config['UPLOAD_CLEANUP_INTERVAL'] = 300
+app.config['RECORD_PAGE_SIZE'] = 100
+app.config['MAX_RECORD_PAGE_SIZE'] = 1000
+app.config['LINK_MAX_DISTANCE'] = 100
+app.config['LINK_BATCH_SIZE'] = 5000
+app.config['IMPORT_WORKERS'] = 1
+app.config['IMPORT_CHUNK_SIZE'] = 10000
+app.config['IMPORT_CHANGE_LOG_LIMIT'] = 10000
+app.config['CHANGE_LOG_RETENTION'] = 86400
+app.config['NEARBY_SYNC_INTERVAL'] = 1.0
+app.config['API_BATCH_SIZE'] = 10000
 db = SQLAlchemy(app)
 
 
+# maintenance commands run long statements (index builds, rollup rebuilds), so they are not held to the statement
+# timeout meant for requests
+@click.group('pycrum', cls=AppGroup, help='Pycrum maintenance commands.')
+def cli():
+    app.config['DB_STATEMENT_TIMEOUT_MS'] = 0
+
+
+app.cli.add_command(cli)
+
+
+# the statement timeout is set once per connection, or at the start of every transaction behind pgbouncer, which
+# hands the server connection to other clients between transactions
+@event.listens_for(Engine, "connect")
+def set_session_timeout(dbapi_connection, connection_record):
+    if app.config['DB_STATEMENT_TIMEOUT_MS'] and not app.config['PGBOUNCER']:
+        cursor = dbapi_connection.cursor()
+        cursor.execute("SET statement_timeout = %s", (app.config['DB_STATEMENT_TIMEOUT_MS'],))
+        cursor.close()
+        # committed, a rollback of the transaction the SET opened would undo it
+        dbapi_connection.commit()
+
+
+@event.listens_for(Engine, "begin")
+def set_transaction_timeout(connection):
+    if app.config['DB_STATEMENT_TIMEOUT_MS'] and app.config['PGBOUNCER']:
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {int(app.config['DB_STATEMENT_TIMEOUT_MS'])}")
+
+
+# lifts the statement timeout for the rest of the session's current transaction. the background imports and the
+# light linking run long statements like the maintenance commands do, while sharing the workers' engine
+def disable_statement_timeout():
+    if app.config['DB_STATEMENT_TIMEOUT_MS']:
+        db.session.execute(text("SET LOCAL statement_timeout = 0"))
+
+
+# a forked child (gunicorn with preload_app, multiprocessing) opens connections of its own instead of sharing the
+# parent's sockets, which are left open for the parent
+def dispose_engine_after_fork():
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=dispose_engine_after_fork)
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 class Customer(db.Model):
     __tablename__ = 'customers'
@@ -35,6 +190,8 @@ class Customer(db.Model):
     number_off = db.Column(db.Integer)
     area = db.Column(db.String(80))
     job_set = db.Column(db.String(120))
+    row_hash = db.Column(db.BigInteger)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
 
     def __init__(self, geolocation, name, address, account_number, premise_number, number_accounted, number_off, area,
                  job_set):
@@ -56,7 +213,7 @@ class Light(db.Model):
     __tablename__ = 'lights'
     id = db.Column(db.Integer, primary_key=True)
     customer = db.relationship('Customer', backref=db.backref('lights'))
-    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=True, index=True)
     geolocation = db.Column(Geometry('POINT'))
     title = db.Column(db.String(120))
     address = db.Column(db.String(120))
@@ -65,6 +222,8 @@ class Light(db.Model):
     area = db.Column(db.String(80))
     job_set = db.Column(db.String(120))
     status = db.Column(db.String(120))
+    row_hash = db.Column(db.BigInteger)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
 
     def __init__(self, geolocation, customer_id, title, address, ptag, lr_number, area, job_set, status):
         self.geolocation = geolocation
@@ -81,82 +240,2139 @@ class Light(db.Model):
         return f'<Light {self.title}>'
 
 
+# single row counter that is bumped by every write to customers or lights, used to key cached map renders
+class DataVersion(db.Model):
+    __tablename__ = 'data_version'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    pruned_version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    def __init__(self, version):
+        self.version = version
+
+    def __repr__(self):
+        return f'<DataVersion {self.version}>'
+
+
+# log of changed records, read by every worker to update its in-memory spatial state incrementally.
+# a change without a record id means the whole layer was reloaded, e.g. by a shapefile import. version is the data
+# version its transaction bumped to, which unlike the id follows the order the transactions committed in
+class RecordChange(db.Model):
+    __tablename__ = 'record_changes'
+    id = db.Column(db.Integer, primary_key=True)
+    layer = db.Column(db.String(20), nullable=False)
+    record_id = db.Column(db.Integer, nullable=True)
+    version = db.Column(db.Integer, index=True)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now(), index=True)
+
+    def __init__(self, layer, record_id, version):
+        self.layer = layer
+        self.record_id = record_id
+        self.version = version
+
+    def __repr__(self):
+        return f'<RecordChange {self.layer} {self.record_id}>'
+
+
+# shapefile import running in the background, progress is kept in the database so any worker can report it.
+# owner is the host:pid of the worker whose thread pool runs it, the job dies with that worker
+class ImportJob(db.Model):
+    __tablename__ = 'import_jobs'
+    id = db.Column(db.String(32), primary_key=True)
+    layer = db.Column(db.String(20), nullable=False)
+    mode = db.Column(db.String(20), nullable=False, default='append')
+    status = db.Column(db.String(20), nullable=False)
+    rows_total = db.Column(db.Integer)
+    rows_processed = db.Column(db.Integer, nullable=False, default=0)
+    rows_changed = db.Column(db.Integer, nullable=False, default=0)
+    rows_per_second = db.Column(db.Float, nullable=False, default=0)
+    error = db.Column(db.Text)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime)
+    owner = db.Column(db.String(255))
+
+    def __init__(self, id, layer, mode, status, created_at, owner=None):
+        self.id = id
+        self.layer = layer
+        self.mode = mode
+        self.status = status
+        self.created_at = created_at
+        self.owner = owner
+
+    def __repr__(self):
+        return f'<ImportJob {self.id} {self.status}>'
+
+
+# number of customers, accounted and off per area and job set, maintained by triggers on customers
+class CustomerRollup(db.Model):
+    __tablename__ = 'customer_rollups'
+    area = db.Column(db.String(80), primary_key=True)
+    job_set = db.Column(db.String(120), primary_key=True)
+    customers = db.Column(db.BigInteger, nullable=False, default=0)
+    number_accounted = db.Column(db.BigInteger, nullable=False, default=0)
+    number_off = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __init__(self, area, job_set):
+        self.area = area
+        self.job_set = job_set
+
+    def __repr__(self):
+        return f'<CustomerRollup {self.area} {self.job_set}>'
+
+
+# number of lights per area and status, maintained by triggers on lights
+class LightRollup(db.Model):
+    __tablename__ = 'light_rollups'
+    area = db.Column(db.String(80), primary_key=True)
+    status = db.Column(db.String(120), primary_key=True)
+    lights = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __init__(self, area, status):
+        self.area = area
+        self.status = status
+
+    def __repr__(self):
+        return f'<LightRollup {self.area} {self.status}>'
+
+
 # ----------------------------------------------------------------------------------------------------------------------
+# returns the current data version, creating the counter row the first time it is needed
+def get_data_version():
+    version = db.session.execute(text("SELECT version FROM data_version WHERE id = 1")).scalar()
+
+    if version is None:
+        db.session.execute(text("INSERT INTO data_version (id, version) VALUES (1, 0) ON CONFLICT (id) DO NOTHING"))
+        db.session.commit()
+        version = db.session.execute(text("SELECT version FROM data_version WHERE id = 1")).scalar()
+
+    return version
+
+
+# bumps the data version inside the current transaction and returns it, callers commit it together with their own
+# changes. the row stays locked until then, so versions become visible strictly in order
+def bump_data_version():
+    return db.session.execute(text("INSERT INTO data_version (id, version) VALUES (1, 1) "
+                                   "ON CONFLICT (id) DO UPDATE SET version = data_version.version + 1 "
+                                   "RETURNING version")).scalar()
+
+
+# records a change to a customer or light (or a whole layer when record_id is None) and bumps the data version
+def record_change(layer, record_id=None):
+    db.session.add(RecordChange(layer=layer, record_id=record_id, version=bump_data_version()))
+
+
+# records a change for each of many records of a layer in one statement
+def record_changes(layer, record_ids):
+    db.session.execute(text("INSERT INTO record_changes (layer, record_id, version) "
+                            "SELECT :layer, unnest(CAST(:record_ids AS integer[])), :version"),
+                       {"layer": layer, "record_ids": list(record_ids), "version": bump_data_version()})
+
+
+# drops change log entries older than CHANGE_LOG_RETENTION seconds and moves pruned_version past them, so a worker
+# that had not read them yet reloads its layers instead of missing the changes. returns the number dropped
+def prune_record_changes():
+    pruned = db.session.execute(text("WITH pruned AS (DELETE FROM record_changes "
+                                     "WHERE created_at < now() - make_interval(secs => :retention) "
+                                     "RETURNING version), "
+                                     "marked AS (UPDATE data_version SET pruned_version = "
+                                     "GREATEST(pruned_version, (SELECT MAX(version) FROM pruned)) "
+                                     "WHERE id = 1 AND EXISTS (SELECT 1 FROM pruned)) "
+                                     "SELECT COUNT(*) FROM pruned"),
+                                {"retention": app.config['CHANGE_LOG_RETENTION']}).scalar()
+    db.session.commit()
+    return pruned
+
+
+@cli.command('prune-changes', help='Drop change log entries older than the retention period.')
+def prune_changes_command():
+    click.echo(f"pruned {prune_record_changes()} change log entries")
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# per worker request metrics: wall time per endpoint, sql query count, sql time and rows per request, and the time
+# spent in named phases such as the steps of generate_shape_map. exposed on /metrics and in a Server-Timing header
+REQUEST_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.phases = {}
+
+    def record_request(self, endpoint, duration, sql_queries, sql_seconds, sql_rows):
+        with self.lock:
+            metric = self.requests.get(endpoint)
+            if metric is None:
+                metric = self.requests[endpoint] = {"count": 0, "seconds": 0.0, "sql_queries": 0,
+                                                    "sql_seconds": 0.0, "sql_rows": 0,
+                                                    "buckets": [0] * len(REQUEST_DURATION_BUCKETS)}
+            metric["count"] += 1
+            metric["seconds"] += duration
+            metric["sql_queries"] += sql_queries
+            metric["sql_seconds"] += sql_seconds
+            metric["sql_rows"] += sql_rows
+            for index, bucket in enumerate(REQUEST_DURATION_BUCKETS):
+                if duration <= bucket:
+                    metric["buckets"][index] += 1
+
+    def record_phase(self, phase, duration):
+        with self.lock:
+            metric = self.phases.setdefault(phase, {"count": 0, "seconds": 0.0})
+            metric["count"] += 1
+            metric["seconds"] += duration
+
+    # prometheus text exposition format
+    def render(self):
+        lines = ["# HELP pycrum_request_duration_seconds Wall time of requests per endpoint.",
+                 "# TYPE pycrum_request_duration_seconds histogram"]
+        with self.lock:
+            for endpoint, metric in sorted(self.requests.items()):
+                for bucket, count in zip(REQUEST_DURATION_BUCKETS, metric["buckets"]):
+                    lines.append(f'pycrum_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bucket}"}} '
+                                 f'{count}')
+                lines.append(f'pycrum_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} '
+                             f'{metric["count"]}')
+                lines.append(f'pycrum_request_duration_seconds_sum{{endpoint="{endpoint}"}} {metric["seconds"]}')
+                lines.append(f'pycrum_request_duration_seconds_count{{endpoint="{endpoint}"}} {metric["count"]}')
+
+            for name, key, help_text in (("sql_queries_total", "sql_queries", "SQL statements run by requests."),
+                                         ("sql_seconds_total", "sql_seconds", "Time spent in SQL by requests."),
+                                         ("sql_rows_total", "sql_rows", "Rows returned to requests by SQL.")):
+                lines.append(f"# HELP pycrum_request_{name} {help_text}")
+                lines.append(f"# TYPE pycrum_request_{name} counter")
+                for endpoint, metric in sorted(self.requests.items()):
+                    lines.append(f'pycrum_request_{name}{{endpoint="{endpoint}"}} {metric[key]}')
+
+            lines.append("# HELP pycrum_phase_duration_seconds Time spent in named phases of a request.")
+            lines.append("# TYPE pycrum_phase_duration_seconds summary")
+            for phase, metric in sorted(self.phases.items()):
+                lines.append(f'pycrum_phase_duration_seconds_sum{{phase="{phase}"}} {metric["seconds"]}')
+                lines.append(f'pycrum_phase_duration_seconds_count{{phase="{phase}"}} {metric["count"]}')
+
+        return "\n".join(lines) + "\n"
+
+
+request_metrics = RequestMetrics()
+
+
+# times a named phase, adding it to the metrics and to the Server-Timing header of the current request
+@contextmanager
+def timed_phase(phase):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start_time
+        request_metrics.record_phase(phase, duration)
+        if has_request_context() and "phases" in g:
+            g.phases.append((phase, duration))
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+    g.sql_rows = 0
+    g.phases = []
+
+
+@app.after_request
+def record_request_timing(response):
+    if "request_start" not in g:
+        return response
+
+    duration = time.perf_counter() - g.request_start
+    request_metrics.record_request(request.endpoint or "unknown", duration, g.sql_queries, g.sql_seconds, g.sql_rows)
+
+    timings = [f"total;dur={duration * 1000:.1f}",
+               f'sql;dur={g.sql_seconds * 1000:.1f};desc="{g.sql_queries} queries, {g.sql_rows} rows"']
+    timings.extend(f"{phase};dur={phase_duration * 1000:.1f}" for phase, phase_duration in g.phases)
+    response.headers["Server-Timing"] = ", ".join(timings)
+    return response
+
+
+# statements are timed on every engine, only the ones run inside a request are added to its totals. the start time
+# is kept on the statement's execution context, so a statement that fails (and never gets after_cursor_execute)
+# leaves nothing behind on the connection
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query_timing(conn, cursor, statement, parameters, context, executemany):
+    query_start = getattr(context, "query_start", None)
+    if query_start is None:
+        return
+    duration = time.perf_counter() - query_start
+    if has_request_context() and "sql_queries" in g:
+        g.sql_queries += 1
+        g.sql_seconds += duration
+        if cursor.description is not None and cursor.rowcount > 0:
+            g.sql_rows += cursor.rowcount
+
+
+# metrics of this worker in the prometheus text format
+@app.route('/metrics')
+def metrics():
+    return Response(request_metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# layers served to the map, with the columns each popup shows
+MAP_LAYERS = {
+    "customers": ["name", "address", "account_number", "premise_number"],
+    "lights": ["title", "address", "ptag", "status"],
+}
+MAX_VIEWPORT_FEATURES = 5000
+
+
+# columns each table is matched on when a shapefile is imported, upserts update the record with the same key and
+# appends skip rows whose key is already there
+UPSERT_KEYS = {
+    "customers": ["account_number", "premise_number"],
+    "lights": ["ptag", "lr_number"],
+}
+
+
+# sql condition that every part of a layer's import key is set. a part left at its shapefile default (or null) is
+# missing, such rows are never matched on their key: the unique index leaves them out and imports always insert
+# them. the condition is null for a null part, so rows without a key are picked with IS NOT TRUE
+def import_key_present(layer):
+    conditions = []
+    for column in UPSERT_KEYS[layer]:
+        default = SHAPEFILE_FIELDS[layer][column][1]
+        conditions.append(f"{column} <> " + (f"'{default}'" if isinstance(default, str) else str(default)))
+    return " AND ".join(conditions)
+
+
+# columns and indexes added after their tables were first created, create_all only creates missing tables
+SCHEMA_UPGRADES = [
+    "CREATE INDEX IF NOT EXISTS ix_lights_customer_id ON lights (customer_id)",
+    "ALTER TABLE customers ADD COLUMN IF NOT EXISTS row_hash BIGINT",
+    "ALTER TABLE lights ADD COLUMN IF NOT EXISTS row_hash BIGINT",
+    "ALTER TABLE customers ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1",
+    "ALTER TABLE lights ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1",
+    """
+CREATE OR REPLACE FUNCTION bump_record_version() RETURNS trigger AS $$
+BEGIN
+    NEW.version := OLD.version + 1;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql""",
+    "ALTER TABLE import_jobs ADD COLUMN IF NOT EXISTS mode VARCHAR(20) NOT NULL DEFAULT 'append'",
+    "ALTER TABLE import_jobs ADD COLUMN IF NOT EXISTS rows_changed INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE import_jobs ADD COLUMN IF NOT EXISTS owner VARCHAR(255)",
+    "ALTER TABLE data_version ADD COLUMN IF NOT EXISTS pruned_version INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE record_changes ADD COLUMN IF NOT EXISTS version INTEGER",
+    "ALTER TABLE record_changes ADD COLUMN IF NOT EXISTS created_at TIMESTAMP NOT NULL DEFAULT now()",
+    "CREATE INDEX IF NOT EXISTS ix_record_changes_version ON record_changes (version)",
+    "CREATE INDEX IF NOT EXISTS ix_record_changes_created_at ON record_changes (created_at)",
+]
+
+
+# brings an existing database up to date with the models: new columns, the gist indexes used by the bounding box
+# queries and the unique indexes imports conflict on
+def upgrade_schema():
+    with db.engine.begin() as connection:
+        for statement in SCHEMA_UPGRADES:
+            connection.execute(text(statement))
+        for table in MAP_LAYERS:
+            connection.execute(text(f"CREATE INDEX IF NOT EXISTS idx_{table}_geolocation "
+                                    f"ON {table} USING gist (geolocation)"))
+            # whatever path a record is changed through, its version moves on for the api's conditional writes
+            connection.execute(text(f"DROP TRIGGER IF EXISTS {table}_version ON {table}"))
+            connection.execute(text(f"CREATE TRIGGER {table}_version BEFORE UPDATE ON {table} FOR EACH ROW "
+                                    f"WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE FUNCTION bump_record_version()"))
+
+    # tables filled by earlier append imports may hold duplicate keys, which have to be removed before importing.
+    # the first version of the index also covered rows without a key, it is replaced by the partial one
+    for table, key in UPSERT_KEYS.items():
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_{table}_import_key_present "
+                                        f"ON {table} ({', '.join(key)}) WHERE {import_key_present(table)}"))
+                connection.execute(text(f"DROP INDEX IF EXISTS uq_{table}_import_key"))
+        except IntegrityError:
+            app.logger.warning("%s has duplicate %s values, until they are removed appends insert every row and "
+                               "upserts fail", table, "/".join(key))
+
+    # prefix and fuzzy search need pg_trgm, which may have to be installed by a superuser
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        trigram = True
+    except DBAPIError:
+        app.logger.warning("pg_trgm is not available, prefix and fuzzy search will scan the tables")
+        trigram = False
+
+    with db.engine.begin() as connection:
+        for statement in search_index_statements(trigram):
+            connection.execute(text(statement))
+
+
+# creates and upgrades the tables, their indexes and the rollup triggers. run once per deploy with
+# flask pycrum init-db rather than by the workers, every statement is safe to run again
+def create_schema():
+    db.create_all()
+    upgrade_schema()
+    create_rollup_triggers()
+
+
+@cli.command('init-db', help='Create or upgrade the tables, indexes and triggers.')
+def init_db_command():
+    start_time = time.perf_counter()
+    create_schema()
+    click.echo(f"database ready in {time.perf_counter() - start_time:.2f}s")
+
+
+# called when a worker boots (see gunicorn.conf.py): opens the pool's connections so the first requests do not pay
+# for connecting, and checks the tables exist so a missing init-db shows up in the log rather than as failed requests
+def warm_up():
+    with app.app_context():
+        pool_size = db.engine.pool.size() if hasattr(db.engine.pool, "size") else 1
+        connections = []
+        try:
+            connections = [db.engine.connect() for _ in range(pool_size)]
+            missing = connections[0].execute(text("SELECT name FROM unnest(CAST(:tables AS text[])) AS name "
+                                                  "WHERE to_regclass(name) IS NULL"),
+                                             {"tables": list(db.metadata.tables)}).scalars().all()
+            for connection in connections[1:]:
+                connection.execute(text("SELECT 1"))
+        except DBAPIError:
+            # the worker still starts, its requests connect when the database is back
+            app.logger.exception("worker %d could not reach the database", os.getpid())
+            return
+        finally:
+            for connection in connections:
+                connection.close()
+
+    if missing:
+        app.logger.error("tables %s are missing, run flask pycrum init-db", ", ".join(sorted(missing)))
+    else:
+        app.logger.info("worker %d warmed %d database connections", os.getpid(), pool_size)
+        with app.app_context():
+            try:
+                fail_orphaned_import_jobs()
+            except DBAPIError:
+                app.logger.exception("could not check for import jobs left by stopped workers")
+            finally:
+                db.session.remove()
+        start_maintenance()
+
+
+# turns a "min_x,min_y,max_x,max_y" string into floats, returns None if it is not a valid bounding box
+def parse_bbox(bbox):
+    try:
+        min_x, min_y, max_x, max_y = [float(value) for value in bbox.split(",")]
+    except (AttributeError, ValueError):
+        return None
+
+    if min_x > max_x or min_y > max_y:
+        return None
+
+    return min_x, min_y, max_x, max_y
+
+
+# queries the features of a layer that fall inside the bounding box, the && operator lets postgis use the gist index
+def query_features_in_bbox(layer, bbox, limit=MAX_VIEWPORT_FEATURES):
+    fields = MAP_LAYERS[layer]
+    rows = db.session.execute(text(f"SELECT id, ST_X(geolocation) AS x, ST_Y(geolocation) AS y, {', '.join(fields)} "
+                                   f"FROM {layer} "
+                                   f"WHERE geolocation && ST_MakeEnvelope(:min_x, :min_y, :max_x, :max_y) "
+                                   f"ORDER BY id LIMIT :limit"),
+                              {"min_x": bbox[0], "min_y": bbox[1], "max_x": bbox[2], "max_y": bbox[3],
+                               "limit": limit + 1}).mappings().all()
+
+    features = []
+    for row in rows[:limit]:
+        properties = {"layer": layer, "id": row["id"]}
+        for field in fields:
+            properties[field] = row[field]
+        features.append({"type": "Feature", "id": f"{layer}.{row['id']}",
+                         "geometry": {"type": "Point", "coordinates": [row["x"], row["y"]]},
+                         "properties": properties})
+
+    # one extra row was queried to tell the client there are more features than were sent
+    return features, len(rows) > limit
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# fields shown in the popups of the full map, the update link is added to them
+MAP_POPUP_FIELDS = {
+    "customers": ["name", "address", "premise_number"],
+    "lights": ["title", "address", "status"],
+}
+
+
+# the located records of a full map layer with the fields its update links carry
+def map_layer_frame(layer):
+    fields = MAP_LAYERS[layer]
+    frame = pd.read_sql(text(f"SELECT id, ST_X(geolocation) AS x, ST_Y(geolocation) AS y, {', '.join(fields)} "
+                             f"FROM {layer} WHERE geolocation IS NOT NULL"), db.engine)
+
+    # integer columns holding nulls are read as floats
+    for field in fields:
+        if pd.api.types.is_float_dtype(frame[field]):
+            frame[field] = frame[field].astype("Int64")
+    return frame
+
+
+# the geojson of a full map layer, holding only the popup fields and the update link. the links are built with
+# whole column string operations in the same record=kind&record=id&record=field... form as url_for makes them
+def map_layer_geojson(layer, frame):
+    fields = MAP_LAYERS[layer]
+    query = f"record={layer[:-1]}&record=" + frame["id"].astype(str)
+    for field in fields:
+        query = query + "&record=" + frame[field].astype("string").fillna("").map(quote_plus).astype(str)
+    frame["link"] = f"<a href='{url_for('update_record_page')}?" + query + "' target='_top'>Update Record</a>"
+
+    # pandas writes the properties to json in one call, json.loads turns them back into dicts without python code
+    # per value
+    properties = json.loads(frame[MAP_POPUP_FIELDS[layer] + ["link"]].to_json(orient="records"))
+    return {"type": "FeatureCollection",
+            "features": [{"type": "Feature", "geometry": {"type": "Point", "coordinates": [x, y]}, "properties": row}
+                         for x, y, row in zip(frame["x"].tolist(), frame["y"].tolist(), properties)]}
+
+
 def generate_shape_map():
-    # use sql and database connection to query customer data and create a geo data frame
-    gdf_customers = gpd.GeoDataFrame.from_postgis("select * from customers", db.engine, geom_col='geolocation')
-    gdf_customers = gdf_customers.set_crs("EPSG:4326")
-
-    # use sql and database connection to query light data and create a geo data frame
-    gdf_lights = gpd.GeoDataFrame.from_postgis("select * from lights", db.engine, geom_col='geolocation')
-    gdf_lights = gdf_lights.set_crs("EPSG:4326")
-
-    # create map
-    m = folium.Map(location=[33.45, -86.75], zoom_start=10)
-
-    # create a folium geojson objects from same dataset
-    geo_customers = folium.GeoJson(data=gdf_customers,
-                                   marker=folium.CircleMarker(radius=10, weight=1, color='black', fill_color='red',
-                                                              fill_opacity=1),
-                                   popup=folium.GeoJsonPopup(fields=['name', 'address', 'premise_number', 'link'],
-                                                             aliases=['Name', 'Address', 'Premise', 'Link'],
-                                                             style=("font-size: 12px; background-color: #fff; "
-                                                                    "border: 2px solid black; border-radius: 3px; "
-                                                                    "box-shadow: 3px")))
-    geo_lights = folium.GeoJson(data=gdf_lights,
-                                marker=folium.CircleMarker(radius=10, weight=1, color='black', fill_color='yellow',
-                                                           fill_opacity=1),
-                                popup=folium.GeoJsonPopup(fields=['title', 'address', 'status', 'link'],
-                                                          aliases=['Title', 'Address', 'Status', 'Link'],
-                                                          style=("font-size: 12px; background-color: #fff; "
-                                                                 "border: 2px solid black; border-radius: 3px; "
-                                                                 "box-shadow: 3px")))
-
-    # loop through geojson features and add a link to update customer info
-    for feature in geo_customers.data["features"]:
-        # create list of customer info to pass to link
-        record_list = ['customer', feature["properties"]["id"], feature["properties"]["name"],
-                       feature["properties"]["address"], feature["properties"]["account_number"],
-                       feature["properties"]["premise_number"]]
-
-        # generate a reference link to customer
-        link = f"<a href='{url_for('update_record_page', record=record_list)}' target='_top'>Update Record</a>"
-        # add link as new field to generate in map popup
-        feature["properties"]["link"] = link
-
-    # loop through geojson features and add a link to update light info
-    for feature in geo_lights.data["features"]:
-        # create list of customer info to pass to link
-        record_list = ['light', feature["properties"]["id"], feature["properties"]["title"],
-                       feature["properties"]["address"], feature["properties"]["ptag"],
-                       feature["properties"]["status"]]
-
-        # generate a reference link to customer
-        link = f"<a href='{url_for('update_record_page', record=record_list)}' target='_top'>Update Record</a>"
-        # add link as new field to generate in map popup
-        feature["properties"]["link"] = link
-
-    geo_customers.add_to(m)
-    geo_lights.add_to(m)
-
-    # save map to be displayed
-    m.save("templates/map.html")
+    with timed_phase("map_query"):
+        # only the popup fields and the fields of the update links of the customers and lights
+        customers = map_layer_frame("customers")
+        lights = map_layer_frame("lights")
+
+    with timed_phase("map_links"):
+        customers = map_layer_geojson("customers", customers)
+        lights = map_layer_geojson("lights", lights)
+
+    with timed_phase("map_geojson"):
+        # create map
+        m = folium.Map(location=[33.45, -86.75], zoom_start=10)
+
+        # create a folium geojson objects from same dataset
+        geo_customers = folium.GeoJson(data=customers,
+                                       marker=folium.CircleMarker(radius=10, weight=1, color='black', fill_color='red',
+                                                                  fill_opacity=1),
+                                       popup=folium.GeoJsonPopup(fields=['name', 'address', 'premise_number', 'link'],
+                                                                 aliases=['Name', 'Address', 'Premise', 'Link'],
+                                                                 style=("font-size: 12px; background-color: #fff; "
+                                                                        "border: 2px solid black; border-radius: 3px; "
+                                                                        "box-shadow: 3px")))
+        geo_lights = folium.GeoJson(data=lights,
+                                    marker=folium.CircleMarker(radius=10, weight=1, color='black', fill_color='yellow',
+                                                               fill_opacity=1),
+                                    popup=folium.GeoJsonPopup(fields=['title', 'address', 'status', 'link'],
+                                                              aliases=['Title', 'Address', 'Status', 'Link'],
+                                                              style=("font-size: 12px; background-color: #fff; "
+                                                                     "border: 2px solid black; border-radius: 3px; "
+                                                                     "box-shadow: 3px")))
+
+    with timed_phase("map_render"):
+        geo_customers.add_to(m)
+        geo_lights.add_to(m)
+
+        # render the map html, saving is handled by the map cache
+        html = m.get_root().render()
+
+    return html
+
+
+# the rendered map is kept in memory and on disk as content addressed files (map-<digest>.html and its .gz and .br
+# variants), with a pointer file naming the data version and digest of the current one
+app.config.setdefault('MAP_FOLDER', 'maps')
+MAP_POINTER = "current"
+MAP_ENCODINGS = {"identity": "", "gzip": ".gz", "br": ".br"}
+map_cache = {"version": None, "digest": None, "variants": None}
+
+
+# writes a file through a temporary file so other workers never read a partially written map or tile
+def write_file_atomic(path, content):
+    temp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(temp_path, "wb") as temp_file:
+        temp_file.write(content)
+    os.replace(temp_path, path)
+
+
+def map_path(digest, encoding="identity"):
+    return os.path.join(app.config['MAP_FOLDER'], f"map-{digest}.html{MAP_ENCODINGS[encoding]}")
+
+
+# the map html in every encoding it can be sent with, compressed once here instead of on every request
+def compress_map(html):
+    content = html.encode("utf-8")
+    variants = {"identity": content, "gzip": gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(content, quality=9)
+    return variants
+
+
+# loads the digest and variants of the map saved on disk if it was generated from the given data version
+def read_saved_map(version):
+    try:
+        with open(os.path.join(app.config['MAP_FOLDER'], MAP_POINTER), encoding="utf-8") as pointer_file:
+            saved_version, digest = pointer_file.read().split()
+        if saved_version != str(version):
+            return None, None
+
+        variants = {}
+        for encoding in MAP_ENCODINGS:
+            path = map_path(digest, encoding)
+            if os.path.exists(path):
+                with open(path, "rb") as map_file:
+                    variants[encoding] = map_file.read()
+        return (digest, variants) if "identity" in variants else (None, None)
+    except (OSError, ValueError):
+        return None, None
+
+
+# saves the variants under their digest, points the other workers at them and removes the maps they replace
+def save_map(version, digest, variants):
+    folder = app.config['MAP_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    for encoding, content in variants.items():
+        write_file_atomic(map_path(digest, encoding), content)
+    write_file_atomic(os.path.join(folder, MAP_POINTER), f"{version} {digest}".encode("utf-8"))
+
+    for file in os.listdir(folder):
+        if file.startswith("map-") and not file.startswith(f"map-{digest}."):
+            try:
+                os.remove(os.path.join(folder, file))
+            except OSError:
+                pass
+
+
+# returns the digest and encoded variants of the rendered map, only regenerating it when the data version has
+# changed since the last render
+def get_cached_map():
+    version = get_data_version()
+
+    if map_cache["version"] != version:
+        # another worker may have already rendered this version to disk
+        digest, variants = read_saved_map(version)
+
+        if variants is None:
+            html = generate_shape_map()
+            with timed_phase("map_save"):
+                variants = compress_map(html)
+                digest = hashlib.sha256(variants["identity"]).hexdigest()[:32]
+                save_map(version, digest, variants)
+
+        map_cache.update(version=version, digest=digest, variants=variants)
+
+    return map_cache["digest"], map_cache["variants"]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# events sent by the point store, a listener overrides the ones it needs
+class PointStoreListener:
+    # reloaded is False for the first load in this worker and True when an import replaced the layer
+    def on_layer_loaded(self, layer, points, reloaded):
+        pass
+
+    # a record's location or light status changed, old_point or new_point is None when it had or has none
+    def on_point_changed(self, layer, record_id, old_point, new_point):
+        pass
+
+    # any logged change to a record, including changes to fields the point store does not keep
+    def on_record_changed(self, layer, record_id, old_point, new_point):
+        pass
+
+    # every change up to this data version has been applied
+    def on_synced(self, version):
+        pass
+
+
+# per worker copy of every point location (and light status), kept in sync through the record_changes log so the
+# spatial indexes built on top of it only have to apply the records that changed since the last request
+class PointStore:
+    def __init__(self):
+        self.points = {layer: {} for layer in MAP_LAYERS}
+        self.synced_version = None
+        self.synced_at = None
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+        if self.synced_version is not None:
+            for layer, points in self.points.items():
+                listener.on_layer_loaded(layer, points, False)
+            listener.on_synced(self.synced_version)
+
+    @staticmethod
+    def point_columns(layer):
+        status = "status" if layer == "lights" else "NULL"
+        return f"id, ST_X(geolocation) AS x, ST_Y(geolocation) AS y, {status} AS status"
+
+    def load_layer(self, layer, reloaded=False):
+        rows = db.session.execute(text(f"SELECT {self.point_columns(layer)} FROM {layer} "
+                                       f"WHERE geolocation IS NOT NULL"))
+        self.points[layer] = {row.id: (row.x, row.y, row.status) for row in rows}
+
+        for listener in self.listeners:
+            listener.on_layer_loaded(layer, self.points[layer], reloaded)
+
+    def load_records(self, layer, record_ids):
+        rows = db.session.execute(text(f"SELECT {self.point_columns(layer)} FROM {layer} "
+                                       f"WHERE id = ANY(:ids) AND geolocation IS NOT NULL"),
+                                  {"ids": list(record_ids)})
+        found = {row.id: (row.x, row.y, row.status) for row in rows}
+
+        for record_id in record_ids:
+            old_point = self.points[layer].pop(record_id, None)
+            new_point = found.get(record_id)
+            if new_point is not None:
+                self.points[layer][record_id] = new_point
+            for listener in self.listeners:
+                if old_point != new_point:
+                    listener.on_point_changed(layer, record_id, old_point, new_point)
+                listener.on_record_changed(layer, record_id, old_point, new_point)
+
+    # applies every change logged since the last sync, or loads everything the first time. changes are read by data
+    # version rather than id: ids are taken when a change is logged, so a transaction that logs first and commits
+    # last would land behind a sync that had already moved past its id. the data version and the changes up to it
+    # are read in one statement, so the pruned_version check sees the log exactly as the changes were read from it.
+    # a caller that can serve data up to max_age seconds old skips the query when the last sync is that recent
+    def sync(self, max_age=None):
+        if max_age and self.synced_at is not None and time.monotonic() - self.synced_at < max_age:
+            return
+        self.synced_at = time.monotonic()
+
+        if self.synced_version is None:
+            self.synced_version = db.session.execute(text("SELECT COALESCE(MAX(version), 0) FROM data_version "
+                                                          "WHERE id = 1")).scalar()
+            for layer in MAP_LAYERS:
+                self.load_layer(layer)
+            for listener in self.listeners:
+                listener.on_synced(self.synced_version)
+            return
+
+        changes = db.session.execute(text("SELECT data_version.version AS latest_version, pruned_version, layer, "
+                                          "record_id FROM data_version LEFT JOIN record_changes "
+                                          "ON record_changes.version > :synced_version "
+                                          "AND record_changes.version <= data_version.version "
+                                          "WHERE data_version.id = 1"),
+                                     {"synced_version": self.synced_version}).all()
+        if not changes or changes[0].latest_version <= self.synced_version:
+            return
+
+        reloaded_layers = set()
+        changed_records = {layer: set() for layer in MAP_LAYERS}
+        if changes[0].pruned_version > self.synced_version:
+            # some of the changes this worker has not applied were pruned from the log
+            reloaded_layers.update(MAP_LAYERS)
+        for change in changes:
+            if change.layer not in MAP_LAYERS:
+                continue
+            if change.record_id is None:
+                reloaded_layers.add(change.layer)
+            else:
+                changed_records[change.layer].add(change.record_id)
+
+        for layer in MAP_LAYERS:
+            if layer in reloaded_layers:
+                self.load_layer(layer, reloaded=True)
+            elif changed_records[layer]:
+                self.load_records(layer, changed_records[layer])
+
+        self.synced_version = changes[0].latest_version
+        for listener in self.listeners:
+            listener.on_synced(self.synced_version)
+
+
+# clusters are grid cells of CLUSTER_CELL_PIXELS screen pixels at every zoom level up to CLUSTER_MAX_ZOOM,
+# above that (or when a viewport holds few enough points) the individual features are sent instead
+CLUSTER_MAX_ZOOM = 16
+CLUSTER_CELL_PIXELS = 64
+CLUSTER_RAW_FEATURE_LIMIT = 500
+CELLS_AT_MAX_ZOOM = (256 // CLUSTER_CELL_PIXELS) * 2 ** CLUSTER_MAX_ZOOM
+
+
+# position of a point in web mercator as fractions of the world, 0 to 1 on both axes
+def mercator_fraction(x, y):
+    y = max(min(y, 85.0511), -85.0511)
+    fraction_x = min(max((x + 180.0) / 360.0, 0.0), 1.0)
+    fraction_y = (1.0 - math.log(math.tan(math.radians(y)) + 1.0 / math.cos(math.radians(y))) / math.pi) / 2.0
+    return fraction_x, fraction_y
+
+
+# the cell holding a point at the deepest zoom, cells at lower zooms are found by shifting it right
+def max_zoom_cell(x, y):
+    fraction_x, fraction_y = mercator_fraction(x, y)
+    cell_x = min(int(fraction_x * CELLS_AT_MAX_ZOOM), CELLS_AT_MAX_ZOOM - 1)
+    cell_y = min(int(fraction_y * CELLS_AT_MAX_ZOOM), CELLS_AT_MAX_ZOOM - 1)
+    return cell_x, cell_y
+
+
+# per zoom grid aggregation of the point store, each cell holds a point count, coordinate sums for the centroid
+# and a count of light statuses. updated point by point as changes come in from the point store
+class ClusterIndex(PointStoreListener):
+    def __init__(self):
+        self.cells = {layer: [{} for _ in range(CLUSTER_MAX_ZOOM + 1)] for layer in MAP_LAYERS}
+
+    def on_layer_loaded(self, layer, points, reloaded):
+        self.cells[layer] = [{} for _ in range(CLUSTER_MAX_ZOOM + 1)]
+        for point in points.values():
+            self.add_point(layer, point, 1)
+
+    def on_point_changed(self, layer, record_id, old_point, new_point):
+        if old_point is not None:
+            self.add_point(layer, old_point, -1)
+        if new_point is not None:
+            self.add_point(layer, new_point, 1)
+
+    # adds (sign=1) or removes (sign=-1) a point from its cell at every zoom level
+    def add_point(self, layer, point, sign):
+        x, y, status = point
+        cell_x, cell_y = max_zoom_cell(x, y)
+
+        for zoom in range(CLUSTER_MAX_ZOOM + 1):
+            shift = CLUSTER_MAX_ZOOM - zoom
+            key = (cell_x >> shift, cell_y >> shift)
+            cell = self.cells[layer][zoom].get(key)
+            if cell is None:
+                cell = self.cells[layer][zoom][key] = [0, 0.0, 0.0, Counter()]
+
+            cell[0] += sign
+            cell[1] += sign * x
+            cell[2] += sign * y
+            if status is not None:
+                cell[3][status] += sign
+                if cell[3][status] <= 0:
+                    del cell[3][status]
+
+            if cell[0] <= 0:
+                del self.cells[layer][zoom][key]
+
+    # returns the non empty cells of a layer that overlap the bounding box at a zoom level
+    def cells_in_bbox(self, layer, zoom, bbox):
+        zoom = max(min(zoom, CLUSTER_MAX_ZOOM), 0)
+        shift = CLUSTER_MAX_ZOOM - zoom
+        min_x, max_y = max_zoom_cell(bbox[0], bbox[1])
+        max_x, min_y = max_zoom_cell(bbox[2], bbox[3])
+        min_x, min_y, max_x, max_y = min_x >> shift, min_y >> shift, max_x >> shift, max_y >> shift
+        cells = self.cells[layer][zoom]
+
+        # walk whichever is smaller, the cells covered by the viewport or the occupied cells
+        if (max_x - min_x + 1) * (max_y - min_y + 1) <= len(cells):
+            for cell_x in range(min_x, max_x + 1):
+                for cell_y in range(min_y, max_y + 1):
+                    cell = cells.get((cell_x, cell_y))
+                    if cell is not None:
+                        yield zoom, cell_x, cell_y, cell
+        else:
+            for (cell_x, cell_y), cell in cells.items():
+                if min_x <= cell_x <= max_x and min_y <= cell_y <= max_y:
+                    yield zoom, cell_x, cell_y, cell
+
+    def clusters_in_bbox(self, layer, zoom, bbox):
+        features = []
+        for zoom, cell_x, cell_y, cell in self.cells_in_bbox(layer, zoom, bbox):
+            count, sum_x, sum_y, statuses = cell
+            properties = {"layer": layer, "cluster": True, "count": count}
+            if layer == "lights":
+                properties["statuses"] = dict(statuses)
+            features.append({"type": "Feature", "id": f"{layer}.cluster.{zoom}.{cell_x}.{cell_y}",
+                             "geometry": {"type": "Point", "coordinates": [sum_x / count, sum_y / count]},
+                             "properties": properties})
+        return features
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# vector tiles are rendered with a buffer of TILE_BUFFER units out of TILE_EXTENT so markers are not cut at the edges
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+TILE_MAX_ZOOM = 22
+app.config.setdefault('TILE_CACHE_SIZE', 2048)
+app.config.setdefault('TILE_CACHE_FOLDER', None)
+
+
+# builds the customers and lights layers of a tile in one query, the tile envelope is moved back to the unset srid
+# of the geolocation columns so the && filter can use their gist indexes
+def render_tile(z, x, y):
+    margin = TILE_BUFFER / TILE_EXTENT
+    layer_queries = []
+    for layer, fields in MAP_LAYERS.items():
+        layer_queries.append(f"COALESCE((SELECT ST_AsMVT(tile, '{layer}', {TILE_EXTENT}, 'geom', 'id') FROM ("
+                             f"SELECT id, {', '.join(fields)}, "
+                             f"ST_AsMVTGeom(ST_Transform(ST_SetSRID(geolocation, 4326), 3857), bounds.envelope, "
+                             f"{TILE_EXTENT}, {TILE_BUFFER}, true) AS geom "
+                             f"FROM {layer}, bounds WHERE geolocation && bounds.filter) AS tile), ''::bytea)")
+
+    tile = db.session.execute(text(f"WITH bounds AS (SELECT ST_TileEnvelope(:z, :x, :y) AS envelope, "
+                                   f"ST_SetSRID(ST_Transform(ST_TileEnvelope(:z, :x, :y, margin => :margin), 4326), "
+                                   f"0) AS filter) "
+                                   f"SELECT {' || '.join(layer_queries)}"),
+                              {"z": z, "x": x, "y": y, "margin": margin}).scalar()
+    return bytes(tile or b"")
+
+
+# the tiles at every zoom level whose buffered area contains a point
+def tiles_for_point(x, y):
+    fraction_x, fraction_y = mercator_fraction(x, y)
+    tiles = set()
+    for zoom in range(TILE_MAX_ZOOM + 1):
+        count = 2 ** zoom
+        buffer = TILE_BUFFER / TILE_EXTENT
+        for offset_x in (-buffer, buffer):
+            for offset_y in (-buffer, buffer):
+                tile_x = min(max(int((fraction_x * count) + offset_x), 0), count - 1)
+                tile_y = min(max(int((fraction_y * count) + offset_y), 0), count - 1)
+                tiles.add((zoom, tile_x, tile_y))
+    return tiles
+
+
+# bounded lru of rendered tiles with an optional copy on disk shared between workers. it listens to the point store
+# so a changed record only evicts the tiles around its old and new location. the disk copy holds the data version
+# it has had every change evicted up to, a worker starting at any other version cannot tell which disk tiles are
+# stale and clears them
+class TileCache(PointStoreListener):
+    def __init__(self, max_size, folder=None):
+        self.tiles = OrderedDict()
+        self.max_size = max_size
+        self.folder = folder
+        self.disk_checked = False
+
+    def tile_path(self, key):
+        z, x, y = key
+        return os.path.join(self.folder, str(z), str(x), f"{y}.pbf")
+
+    def get(self, key):
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            return tile
+
+        if self.folder:
+            try:
+                with open(self.tile_path(key), "rb") as tile_file:
+                    tile = tile_file.read()
+            except OSError:
+                return None
+            self.put(key, tile, save=False)
+
+        return tile
+
+    def put(self, key, tile, save=True):
+        self.tiles[key] = tile
+        self.tiles.move_to_end(key)
+        while len(self.tiles) > self.max_size:
+            self.tiles.popitem(last=False)
+
+        if save and self.folder:
+            path = self.tile_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_file_atomic(path, tile)
+
+    def evict(self, key):
+        self.tiles.pop(key, None)
+        if self.folder:
+            try:
+                os.remove(self.tile_path(key))
+            except OSError:
+                pass
+
+    def clear(self, include_disk):
+        self.tiles.clear()
+        if include_disk and self.folder:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+    def disk_version(self):
+        try:
+            with open(os.path.join(self.folder, "version"), "rb") as version_file:
+                return int(version_file.read())
+        except (OSError, ValueError):
+            return None
+
+    def on_layer_loaded(self, layer, points, reloaded):
+        # the first load in a worker leaves the shared disk tiles to on_synced, an import invalidates all of them
+        self.clear(include_disk=reloaded)
+
+    def on_record_changed(self, layer, record_id, old_point, new_point):
+        # every tile field can change without the point moving, so any change evicts the tiles around the record
+        for point in (old_point, new_point):
+            if point is not None:
+                for key in tiles_for_point(point[0], point[1]):
+                    self.evict(key)
+
+    def on_synced(self, version):
+        if not self.folder:
+            return
+
+        disk_version = self.disk_version()
+        if not self.disk_checked:
+            self.disk_checked = True
+            if disk_version != version:
+                self.clear(include_disk=True)
+                disk_version = None
+
+        if disk_version is None or version > disk_version:
+            os.makedirs(self.folder, exist_ok=True)
+            write_file_atomic(os.path.join(self.folder, "version"), str(version).encode())
+
+
+# distances are measured on a sphere, as ST_DistanceSphere does for the light linking. the lookups pick up changes
+# from the point store at most every NEARBY_SYNC_INTERVAL seconds, so most of them never touch the database
+EARTH_RADIUS = 6371008.8
+NEARBY_REBUILD_CHANGES = 1000
+NEARBY_MAX_RESULTS = 1000
+
+
+# great circle distance in meters from one point to arrays of points
+def haversine_distance(x, y, xs, ys):
+    lat, lats = math.radians(y), np.radians(ys)
+    delta_x = np.radians(xs) - math.radians(x)
+    a = np.sin((lats - lat) / 2) ** 2 + math.cos(lat) * np.cos(lats) * np.sin(delta_x / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+# radius and nearest lookups answered from memory. each layer keeps its ids and coordinates in numpy arrays with an
+# strtree over them, built on the first lookup after a load. changes from the point store are kept beside the tree
+# (moved and new points in added, stale tree entries in removed) until there are enough of them to rebuild it
+class NearbyIndex(PointStoreListener):
+    def __init__(self):
+        self.points = {layer: {} for layer in MAP_LAYERS}
+        self.trees = {layer: None for layer in MAP_LAYERS}
+        self.added = {layer: {} for layer in MAP_LAYERS}
+        self.removed = {layer: set() for layer in MAP_LAYERS}
+
+    def on_layer_loaded(self, layer, points, reloaded):
+        # the point store's own dict, which it keeps current, so a rebuild never has to query the database
+        self.points[layer] = points
+        self.trees[layer] = None
+
+    def on_point_changed(self, layer, record_id, old_point, new_point):
+        if self.trees[layer] is None:
+            return
+        self.removed[layer].add(record_id)
+        self.added[layer].pop(record_id, None)
+        if new_point is not None:
+            self.added[layer][record_id] = new_point
+        if len(self.removed[layer]) > max(NEARBY_REBUILD_CHANGES, len(self.trees[layer]["ids"]) // 10):
+            self.trees[layer] = None
+
+    def get_tree(self, layer):
+        tree = self.trees[layer]
+        if tree is None:
+            points = self.points[layer]
+            ids = np.fromiter(points.keys(), dtype=np.int64, count=len(points))
+            coordinates = np.array([point[:2] for point in points.values()], dtype=np.float64).reshape(-1, 2)
+            tree = {"ids": ids, "coordinates": coordinates,
+                    "statuses": np.array([point[2] for point in points.values()], dtype=object),
+                    "strtree": shapely.STRtree(shapely.points(coordinates))}
+            self.trees[layer] = tree
+            self.added[layer] = {}
+            self.removed[layer] = set()
+        return tree
+
+    # (distance, id, x, y, status) of every point within radius meters of x, y, nearest first
+    def within(self, layer, x, y, radius):
+        tree = self.get_tree(layer)
+
+        # the radius as a box in degrees, widened towards the poles where a degree of longitude gets shorter
+        degrees_y = math.degrees(radius / EARTH_RADIUS)
+        cos_y = math.cos(math.radians(min(abs(y) + degrees_y, 90)))
+        degrees_x = 180 if cos_y < 1e-9 else min(degrees_y / cos_y, 180)
+        box = shapely.box(x - degrees_x, y - degrees_y, x + degrees_x, y + degrees_y)
+
+        candidates = tree["strtree"].query(box)
+        if self.removed[layer]:
+            candidates = candidates[~np.isin(tree["ids"][candidates], list(self.removed[layer]))]
+        coordinates = tree["coordinates"][candidates]
+        distances = haversine_distance(x, y, coordinates[:, 0], coordinates[:, 1])
+        inside = distances <= radius
+
+        results = list(zip(distances[inside].tolist(), tree["ids"][candidates][inside].tolist(),
+                           coordinates[inside, 0].tolist(), coordinates[inside, 1].tolist(),
+                           tree["statuses"][candidates][inside].tolist()))
+        for record_id, (point_x, point_y, status) in self.added[layer].items():
+            distance = float(haversine_distance(x, y, point_x, point_y))
+            if distance <= radius:
+                results.append((distance, record_id, point_x, point_y, status))
+
+        results.sort()
+        return results
+
+    # the count points nearest to x, y, no further than max_distance meters. the tree's nearest point (in degrees)
+    # gives a first radius that holds the true nearest one, which is doubled until enough points are found
+    def nearest(self, layer, x, y, count=1, max_distance=None):
+        tree = self.get_tree(layer)
+        if len(tree["ids"]) == 0 and not self.added[layer]:
+            return []
+
+        max_distance = math.pi * EARTH_RADIUS if max_distance is None else max_distance
+        radius = 1.0
+        if len(tree["ids"]):
+            index = tree["strtree"].nearest(shapely.Point(x, y))
+            point_x, point_y = tree["coordinates"][index]
+            radius = max(float(haversine_distance(x, y, point_x, point_y)), radius)
+
+        while True:
+            radius = min(radius, max_distance)
+            results = self.within(layer, x, y, radius)
+            if len(results) >= count or radius >= max_distance:
+                return results[:count]
+            radius *= 2
+
+
+point_store = PointStore()
+cluster_index = ClusterIndex()
+tile_cache = TileCache(app.config['TILE_CACHE_SIZE'], app.config['TILE_CACHE_FOLDER'])
+nearby_index = NearbyIndex()
+point_store.add_listener(cluster_index)
+point_store.add_listener(tile_cache)
+point_store.add_listener(nearby_index)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# shapefile columns copied into each table as (shapefile column, default), a column of None is filled with the default
+SHAPEFILE_FIELDS = {
+    "customers": {
+        "name": ("Customer_N", ""),
+        "address": ("Service_Ad", ""),
+        "account_number": ("Account_Nu", 0),
+        "premise_number": ("Premise_Nu", 0),
+        "number_accounted": ("Number_Act", 0),
+        "number_off": ("Number_Ina", 0),
+        "area": ("AREA", ""),
+        "job_set": ("JOBSET", ""),
+    },
+    "lights": {
+        "title": ("Title", ""),
+        "address": (None, ""),
+        "ptag": ("PTAG", 0),
+        "lr_number": ("LR_NUMBER", ""),
+        "area": ("AREA", ""),
+        "job_set": ("JOBSET", ""),
+        "status": ("Status", ""),
+    },
+}
+
+
+# columns shown in the upload preview for each file type
+SHAPEFILE_PREVIEW_COLUMNS = {
+    "customers": ["Customer_N", "Service_Ad", "Account_Nu", "Premise_Nu"],
+    "lights": ["Status", "Title", "PTAG", "LR_NUMBER"],
+}
+
+
+# reads count features starting at start, only loading the given columns (and the geometry when asked for)
+def read_shapefile(shapefile, columns=None, start=0, count=None, geometry=True):
+    if pyogrio.available():
+        return pyogrio.read_dataframe(shapefile, columns=columns, skip_features=start, max_features=count,
+                                      read_geometry=geometry)
+
+    rows = slice(start, start + count if count is not None else None)
+    gdf = gpd.read_file(shapefile, rows=rows)
+    if columns is not None:
+        gdf = gdf[[column for column in columns if column in gdf.columns] + (["geometry"] if geometry else [])]
+    return gdf
+
+
+# number of features in a shapefile, None when it can not be read without going through the whole file
+def count_shapefile_features(shapefile):
+    if pyogrio.available():
+        return pyogrio.read_info(shapefile)["features"]
+    return None
+
+
+# yields the shapefile in frames of at most chunk_size features holding the columns a table import needs,
+# so the memory used by an import does not grow with the size of the file
+def iter_shapefile_chunks(shapefile, layer, chunk_size):
+    columns = [source for source, default in SHAPEFILE_FIELDS[layer].values() if source is not None]
+    start = 0
+    while True:
+        chunk = read_shapefile(shapefile, columns=columns, start=start, count=chunk_size)
+        if len(chunk) == 0:
+            return
+        yield chunk
+        start += len(chunk)
+        if len(chunk) < chunk_size:
+            return
+
+
+# stored points are lon/lat, the geolocation columns themselves carry no srid
+GEOMETRY_CRS = "EPSG:4326"
+
+
+# whether x and y are a finite lon/lat
+def valid_coordinates(x, y):
+    return math.isfinite(x) and math.isfinite(y) and abs(x) <= 180 and abs(y) <= 90
+
+
+# moves a geo series to lon/lat in one batch and returns its geometries as a shapely array, along with a mask of
+# the ones that are points with valid coordinates. a shapefile without a projection is taken to be lon/lat
+def prepare_points(geometry):
+    if geometry.crs is None:
+        geometry = geometry.set_crs(GEOMETRY_CRS)
+    elif geometry.crs != GEOMETRY_CRS:
+        geometry = geometry.to_crs(GEOMETRY_CRS)
+
+    points = np.asarray(geometry.array)
+    x, y = shapely.get_x(points), shapely.get_y(points)
+    valid = np.isfinite(x) & np.isfinite(y) & (np.abs(x) <= 180) & (np.abs(y) <= 90)
+    return points, valid & (shapely.get_type_id(points) == shapely.GeometryType.POINT)
+
+
+# the point stored for the longitude and latitude typed into the record forms, None when they are not valid
+FORM_POINT_INVALID = "Not saved, the latitude has to be between -90 and 90 and the longitude between -180 and 180"
+
+
+def form_point(x, y):
+    try:
+        x, y = float(x), float(y)
+    except (TypeError, ValueError):
+        return None
+    if not valid_coordinates(x, y):
+        return None
+    return WKTElement(f"POINT({x} {y})")
+
+
+# converts a shapefile geo data frame into the columns of a table with whole column operations, the geometry is
+# written as hex wkb which postgis reads directly without parsing wkt. rows without a valid point are skipped.
+# pointz files are common from survey gear, their z is dropped since the geolocation columns are 2d
+def shapefile_to_frame(gdf, layer):
+    points, valid = prepare_points(gdf.geometry)
+    skipped = len(valid) - int(valid.sum())
+    if skipped:
+        app.logger.warning("skipped %d %s without a valid point", skipped, layer)
+
+    gdf = gdf[valid]
+    frame = pd.DataFrame({"geolocation": shapely.to_wkb(points[valid], hex=True, output_dimension=2)}, index=gdf.index)
+
+    for column, (source, default) in SHAPEFILE_FIELDS[layer].items():
+        if source is None or source not in gdf.columns:
+            frame[column] = default
+        elif isinstance(default, int):
+            values = pd.to_numeric(gdf[source], errors="coerce")
+            frame[column] = values.fillna(default).astype("int64")
+        else:
+            values = gdf[source].astype("string")
+            frame[column] = values.mask(values.str.len() == 0).fillna(default)
+
+    # content hash of every imported column, used by upsert imports to skip rows that have not changed
+    frame["row_hash"] = pd.util.hash_pandas_object(frame, index=False).astype("int64")
+
+    return frame
+
+
+# streams a frame into a table with postgres COPY on the session connection, so the rows are committed in the
+# same transaction as the rest of the session. returns the number of rows copied. missing values are written as \N,
+# csv's own null (an empty field) would also turn empty strings into nulls
+def copy_frame(table, frame):
+    buffer = StringIO()
+    frame.to_csv(buffer, index=False, header=False, na_rep="\\N")
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {table} ({', '.join(frame.columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+                           buffer)
+    finally:
+        cursor.close()
+
+    return len(frame)
+
+
+# whether the unique index imports conflict on is there, init-db leaves it out while a table holds duplicate keys
+def import_key_indexed(layer):
+    return db.session.execute(text("SELECT to_regclass(:index) IS NOT NULL"),
+                              {"index": f"uq_{layer}_import_key_present"}).scalar()
+
+
+# copies a frame into a staging table and merges it into the layer on its import key. in upsert mode a row whose
+# key is already there updates that record, unless its content hash matches the stored one. in append mode it is
+# skipped. rows without a key are always inserted. without the unique index an append inserts every row, as
+# appends did before there were import keys, and an upsert fails. returns the ids of the rows written
+def merge_frame(layer, frame, mode):
+    staging = f"staging_{layer}"
+    columns = ", ".join(frame.columns)
+    key = ", ".join(UPSERT_KEYS[layer])
+    key_present = import_key_present(layer)
+
+    db.session.execute(text(f"CREATE TEMP TABLE IF NOT EXISTS {staging} ON COMMIT DROP AS "
+                            f"SELECT {columns} FROM {layer} WITH NO DATA"))
+    db.session.execute(text(f"TRUNCATE {staging}"))
+    copy_frame(staging, frame)
+
+    if not import_key_indexed(layer):
+        if mode == "upsert":
+            raise ValueError(f"{layer} holds duplicate {' / '.join(UPSERT_KEYS[layer])} values, remove them and "
+                             f"run flask pycrum init-db before updating records from a shapefile")
+        return db.session.execute(text(f"INSERT INTO {layer} ({columns}) SELECT {columns} FROM {staging} "
+                                       f"RETURNING id")).scalars().all()
+
+    # a key repeated inside the file would make the insert touch the same row twice. staging is only ever filled by
+    # one COPY after a truncate, so its ctid order is the order of the file: an upsert keeps the last row, as a later
+    # chunk overwrites an earlier one, and an append keeps the first, as a later chunk is skipped
+    if mode == "upsert":
+        updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in frame.columns)
+        conflict = f"DO UPDATE SET {updates} WHERE {layer}.row_hash IS DISTINCT FROM EXCLUDED.row_hash"
+        order = "ctid DESC"
+    else:
+        conflict = "DO NOTHING"
+        order = "ctid"
+
+    keyed = db.session.execute(text(f"INSERT INTO {layer} ({columns}) "
+                                    f"SELECT DISTINCT ON ({key}) {columns} FROM {staging} WHERE {key_present} "
+                                    f"ORDER BY {key}, {order} "
+                                    f"ON CONFLICT ({key}) WHERE {key_present} {conflict} "
+                                    f"RETURNING id")).scalars().all()
+    unkeyed = db.session.execute(text(f"INSERT INTO {layer} ({columns}) "
+                                      f"SELECT {columns} FROM {staging} WHERE ({key_present}) IS NOT TRUE "
+                                      f"RETURNING id")).scalars().all()
+    return keyed + unkeyed
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# links a batch of lights to their nearest customer. the customers gist index finds the few customers inside a box
+# of max_distance around the light (:degrees of latitude, widened for longitude towards the poles), which are then
+# ranked by their distance in meters. <-> would rank them in degrees, where a degree of longitude is shorter than
+# one of latitude away from the equator, so it can pick a customer that is not the nearest
+LINK_LIGHTS_QUERY = """
+UPDATE lights SET customer_id = nearest.customer_id
+FROM (SELECT light.id AS light_id, customer.id AS customer_id
+      FROM lights AS light
+      CROSS JOIN LATERAL (SELECT id FROM customers
+                          WHERE geolocation && ST_Expand(light.geolocation,
+                                  :degrees / cos(radians(LEAST(abs(ST_Y(light.geolocation)) + :degrees, 89.9))),
+                                  :degrees)
+                            AND ST_DistanceSphere(geolocation, light.geolocation) <= :max_distance
+                          ORDER BY ST_DistanceSphere(geolocation, light.geolocation), id LIMIT 1) AS customer
+      WHERE light.id = ANY(:light_ids)) AS nearest
+WHERE lights.id = nearest.light_id
+"""
+
+
+# assigns lights to the nearest customer within max_distance meters, batch by batch with a commit after each.
+# only lights without a customer are linked unless relink is set, and only lights with an id above after_id, so an
+# import links just the lights it added. returns the number of lights linked
+def link_lights_to_customers(max_distance=None, batch_size=None, relink=False, after_id=0):
+    max_distance = max_distance or app.config['LINK_MAX_DISTANCE']
+    batch_size = batch_size or app.config['LINK_BATCH_SIZE']
+    unlinked = "" if relink else "AND customer_id IS NULL"
+    # ST_DistanceSphere's earth is a little smaller than EARTH_RADIUS, the box gets a margin for it
+    degrees = math.degrees(max_distance / EARTH_RADIUS) * 1.01
+
+    linked = 0
+    last_id = after_id
+    while True:
+        disable_statement_timeout()
+        light_ids = db.session.execute(text(f"SELECT id FROM lights WHERE id > :last_id {unlinked} "
+                                            f"AND geolocation IS NOT NULL ORDER BY id LIMIT :limit"),
+                                       {"last_id": last_id, "limit": batch_size}).scalars().all()
+        if not light_ids:
+            break
+
+        result = db.session.execute(text(LINK_LIGHTS_QUERY), {"light_ids": light_ids, "max_distance": max_distance,
+                                                              "degrees": degrees})
+        db.session.commit()
+        linked += result.rowcount
+        last_id = light_ids[-1]
+
+    if linked:
+        bump_data_version()
+        db.session.commit()
+
+    return linked
+
+
+@cli.command('link-lights', help='Link lights to their nearest customer.')
+@click.option('--max-distance', type=float, default=None, help='Largest distance in meters to link a light over.')
+@click.option('--batch-size', type=int, default=None, help='Number of lights linked per transaction.')
+@click.option('--relink', is_flag=True, help='Also relink lights that already have a customer.')
+def link_lights_command(max_distance, batch_size, relink):
+    start_time = time.perf_counter()
+    linked = link_lights_to_customers(max_distance, batch_size, relink)
+    click.echo(f"linked {linked} lights in {time.perf_counter() - start_time:.2f}s")
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# rollups are kept up to date by statement level triggers on customers and lights, so every write path (the crud
+# routes, COPY imports and upserts) adds its delta in the same transaction. the deltas are only appended to
+# <rollup>_deltas: adding them to the rollup rows directly would lock an area's rows until the transaction ends,
+# which for an import is its last chunk, and block every other write to that area. the deltas are folded into the
+# rollup by the maintenance thread and added to it when the rollup is read. each rollup is (group columns, sums)
+# where a sum is (rollup column, expression over a changed row)
+ROLLUPS = {
+    "customer_rollups": {
+        "table": "customers",
+        "group": ["area", "job_set"],
+        "sums": [("customers", "1"), ("number_accounted", "COALESCE(number_accounted, 0)"),
+                 ("number_off", "COALESCE(number_off, 0)")],
+    },
+    "light_rollups": {
+        "table": "lights",
+        "group": ["area", "status"],
+        "sums": [("lights", "1")],
+    },
+}
+
+
+def rollup_columns(rollup):
+    definition = ROLLUPS[rollup]
+    return ", ".join(definition["group"] + [column for column, expression in definition["sums"]])
+
+
+# insert that adds the rows of a table (or transition table) to a rollup table, or to its deltas, with sign 1 or -1
+def rollup_delta_query(rollup, rows_table, sign, target):
+    definition = ROLLUPS[rollup]
+    group = ", ".join(f"COALESCE({column}, '') AS {column}" for column in definition["group"])
+    sums = ", ".join(f"{sign} * SUM({expression}) AS {column}" for column, expression in definition["sums"])
+    # grouped by position, by name postgres would group on the raw columns and split null from ''
+    positions = ", ".join(str(position) for position in range(1, len(definition["group"]) + 1))
+    return (f"INSERT INTO {target} ({rollup_columns(rollup)}) SELECT {group}, {sums} FROM {rows_table} "
+            f"GROUP BY {positions}")
+
+
+# moves the committed deltas into the rollup rows. the rows are upserted in group order, so two folds running at
+# once lock them in the same order and cannot deadlock, and a delta deleted by one of them is skipped by the other
+def fold_rollup_query(rollup):
+    definition = ROLLUPS[rollup]
+    group = ", ".join(definition["group"])
+    sums = ", ".join(f"SUM({column})" for column, expression in definition["sums"])
+    updates = ", ".join(f"{column} = {rollup}.{column} + EXCLUDED.{column}"
+                        for column, expression in definition["sums"])
+    return (f"WITH moved AS (DELETE FROM {rollup}_deltas RETURNING *) "
+            f"INSERT INTO {rollup} ({rollup_columns(rollup)}) SELECT {group}, {sums} FROM moved "
+            f"GROUP BY {group} ORDER BY {group} "
+            f"ON CONFLICT ({group}) DO UPDATE SET {updates}")
+
+
+# the rollup with the deltas not folded in yet added to it, as a subquery
+def current_rollup_query(rollup):
+    definition = ROLLUPS[rollup]
+    group = ", ".join(definition["group"])
+    sums = ", ".join(f"CAST(SUM({column}) AS bigint) AS {column}" for column, expression in definition["sums"])
+    columns = rollup_columns(rollup)
+    return (f"(SELECT {group}, {sums} FROM (SELECT {columns} FROM {rollup} UNION ALL "
+            f"SELECT {columns} FROM {rollup}_deltas) AS parts GROUP BY {group}) AS {rollup}")
+
+
+# trigger functions and one trigger per operation, postgres does not allow transition tables on multi event
+# triggers. truncating the table empties the rollup
+def rollup_trigger_statements(rollup):
+    table = ROLLUPS[rollup]["table"]
+    deltas = f"{rollup}_deltas"
+    statements = [f"CREATE TABLE IF NOT EXISTS {deltas} (LIKE {rollup})", f"""
+CREATE OR REPLACE FUNCTION {rollup}_delta() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        {rollup_delta_query(rollup, "old_rows", -1, deltas)};
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        {rollup_delta_query(rollup, "new_rows", 1, deltas)};
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql""", f"""
+CREATE OR REPLACE FUNCTION {rollup}_truncate() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM {rollup};
+    DELETE FROM {deltas};
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql"""]
+
+    for operation, transitions in (("INSERT", "NEW TABLE AS new_rows"),
+                                   ("UPDATE", "OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+                                   ("DELETE", "OLD TABLE AS old_rows")):
+        trigger = f"{rollup}_{operation.lower()}"
+        statements.append(f"DROP TRIGGER IF EXISTS {trigger} ON {table}")
+        statements.append(f"CREATE TRIGGER {trigger} AFTER {operation} ON {table} REFERENCING {transitions} "
+                          f"FOR EACH STATEMENT EXECUTE FUNCTION {rollup}_delta()")
+    statements.append(f"DROP TRIGGER IF EXISTS {rollup}_truncate ON {table}")
+    statements.append(f"CREATE TRIGGER {rollup}_truncate AFTER TRUNCATE ON {table} "
+                      f"FOR EACH STATEMENT EXECUTE FUNCTION {rollup}_truncate()")
+    return statements
+
+
+# recomputes a rollup from its table, with writes to the table blocked until the transaction ends
+def rebuild_rollup(connection, rollup):
+    definition = ROLLUPS[rollup]
+    connection.execute(text(f"LOCK TABLE {definition['table']} IN SHARE MODE"))
+    connection.execute(text(f"TRUNCATE {rollup}, {rollup}_deltas"))
+    connection.execute(text(rollup_delta_query(rollup, definition["table"], 1, rollup)))
+
+
+# folds the deltas of every rollup into it, each in a short transaction of its own
+def fold_rollups():
+    for rollup in ROLLUPS:
+        with db.engine.begin() as connection:
+            connection.execute(text(fold_rollup_query(rollup)))
+
+
+# installs the rollup triggers when flask pycrum init-db finds them missing, and fills the rollups from the tables
+def create_rollup_triggers():
+    for rollup in ROLLUPS:
+        with db.engine.begin() as connection:
+            # the deltas table came with the current triggers, an older install without it is replaced
+            installed = text("SELECT to_regclass(:deltas) IS NOT NULL "
+                             "AND EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = :trigger)")
+            names = {"deltas": f"{rollup}_deltas", "trigger": f"{rollup}_truncate"}
+            if connection.execute(installed, names).scalar():
+                continue
+
+            # checked again once locked, an init-db run from another host may have installed them meanwhile
+            connection.execute(text(f"LOCK TABLE {ROLLUPS[rollup]['table']} IN SHARE ROW EXCLUSIVE MODE"))
+            if connection.execute(installed, names).scalar():
+                continue
+            for statement in rollup_trigger_statements(rollup):
+                connection.execute(text(statement))
+            rebuild_rollup(connection, rollup)
+
+
+@cli.command('rebuild-rollups', help='Recompute the area, job set and status rollups from the tables.')
+def rebuild_rollups_command():
+    for rollup in ROLLUPS:
+        with db.engine.begin() as connection:
+            rebuild_rollup(connection, rollup)
+    click.echo("rollups rebuilt")
+
+
+# reads the rollups into the counts shown on the summary page
+def load_summary():
+    customer_rows = db.session.execute(text(f"SELECT area, job_set, customers, number_accounted, number_off "
+                                            f"FROM {current_rollup_query('customer_rollups')} WHERE customers > 0 "
+                                            f"ORDER BY area, job_set")).mappings().all()
+    light_rows = db.session.execute(text(f"SELECT area, status, lights "
+                                         f"FROM {current_rollup_query('light_rollups')} WHERE lights > 0 "
+                                         f"ORDER BY area, status")).mappings().all()
+
+    statuses = sorted({row["status"] for row in light_rows})
+    light_areas = {}
+    for row in light_rows:
+        light_areas.setdefault(row["area"], dict.fromkeys(statuses, 0))[row["status"]] = row["lights"]
+
+    return {"customers": [dict(row) for row in customer_rows],
+            "statuses": statuses,
+            "lights": [{"area": area, "statuses": counts, "lights": sum(counts.values())}
+                       for area, counts in light_areas.items()]}
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# imports run on a small pool of threads per worker, created on first use so it is never inherited through a fork
+import_executor = None
+
+
+def get_import_executor():
+    global import_executor
+    if import_executor is None:
+        import_executor = ThreadPoolExecutor(max_workers=app.config['IMPORT_WORKERS'],
+                                             thread_name_prefix="pycrum-import")
+    return import_executor
+
+
+# updates a job on its own connection and commits right away, so progress is visible while the import is still open
+def update_import_job(job_id, **values):
+    assignments = ", ".join(f"{column} = :{column}" for column in values)
+    with db.engine.begin() as connection:
+        connection.execute(text(f"UPDATE import_jobs SET {assignments} WHERE id = :job_id"),
+                           dict(values, job_id=job_id))
+
+
+# the worker process running the jobs it queues, as host:pid
+def import_job_owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+# whether the worker owning a job is gone. only workers on this host can be checked, and a worker that is just
+# starting owns no jobs yet, so one that names its pid was left by an earlier process with the same pid
+def import_job_orphaned(owner):
+    host, _, pid = (owner or "").rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    if int(pid) == os.getpid():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        return False
+    return False
+
+
+# fails the queued and running jobs of workers on this host that are gone, e.g. killed by a timeout or a deploy
+# mid import, so their progress pages stop waiting. called when a worker boots
+def fail_orphaned_import_jobs():
+    jobs = db.session.execute(text("SELECT id, owner FROM import_jobs WHERE status IN ('queued', 'running')")).all()
+    for job in jobs:
+        if import_job_orphaned(job.owner):
+            update_import_job(job.id, status="failed", error="the worker running the import stopped",
+                              finished_at=datetime.utcnow())
+            shutil.rmtree(os.path.join(app.config["UPLOAD_FOLDER"], "jobs", job.id), ignore_errors=True)
+            app.logger.warning("import %s: marked failed, its worker %s is gone", job.id, job.owner)
+
+
+def import_cancel_requested(job_id):
+    with db.engine.connect() as connection:
+        return connection.execute(text("SELECT cancel_requested FROM import_jobs WHERE id = :job_id"),
+                                  {"job_id": job_id}).scalar()
+
+
+# reads the shapefile and appends (or upserts) it chunk by chunk inside one transaction, checking for cancellation
+# between chunks. the job folder holding the uploaded files is removed when the job ends
+def run_import_job(job_id, job_folder, shapefile, layer, mode):
+    with app.app_context():
+        try:
+            if import_cancel_requested(job_id):
+                update_import_job(job_id, status="cancelled", finished_at=datetime.utcnow())
+                return
+
+            update_import_job(job_id, status="running", rows_total=count_shapefile_features(shapefile))
+            start_time = time.perf_counter()
+            disable_statement_timeout()
+            # lights added by this import get ids above the largest one now, only those are linked afterwards
+            last_light_id = db.session.execute(text("SELECT COALESCE(MAX(id), 0) FROM lights")).scalar()
+
+            rows_processed = 0
+            rows_changed = 0
+            changed_ids = []
+            for chunk in iter_shapefile_chunks(shapefile, layer, app.config['IMPORT_CHUNK_SIZE']):
+                if import_cancel_requested(job_id):
+                    db.session.rollback()
+                    update_import_job(job_id, status="cancelled", finished_at=datetime.utcnow())
+                    return
+
+                frame = shapefile_to_frame(chunk, layer)
+                written_ids = merge_frame(layer, frame, mode)
+                rows_processed += len(frame)
+                rows_changed += len(written_ids)
+                if rows_changed <= app.config['IMPORT_CHANGE_LOG_LIMIT']:
+                    changed_ids.extend(written_ids)
+
+                elapsed = time.perf_counter() - start_time
+                update_import_job(job_id, rows_processed=rows_processed, rows_changed=rows_changed,
+                                  rows_per_second=rows_processed / elapsed if elapsed else 0)
+
+            # let the map caches know what changed, committed with the imported rows. a small import is logged
+            # record by record so the caches update incrementally instead of reloading the whole layer
+            if rows_changed > app.config['IMPORT_CHANGE_LOG_LIMIT']:
+                record_change(layer)
+            elif changed_ids:
+                record_changes(layer, changed_ids)
+            db.session.commit()
+            if rows_changed < rows_processed:
+                app.logger.info("import %s: %d rows left as they were", job_id, rows_processed - rows_changed)
+
+            # newly imported lights are linked to the customer nearest to them
+            if layer == "lights":
+                app.logger.info("import %s: linked %d lights", job_id,
+                                link_lights_to_customers(after_id=last_light_id))
+
+            elapsed = time.perf_counter() - start_time
+            app.logger.info("import %s: %d %s in %.2fs", job_id, rows_processed, layer, elapsed)
+            update_import_job(job_id, status="finished", rows_total=rows_processed, finished_at=datetime.utcnow())
+
+        except Exception as error:
+            db.session.rollback()
+            app.logger.exception("import %s failed", job_id)
+            update_import_job(job_id, status="failed", error=str(error), finished_at=datetime.utcnow())
+
+        finally:
+            db.session.remove()
+            shutil.rmtree(job_folder, ignore_errors=True)
+
+
+# every upload is staged in a folder of its own under uploads/staging, named by a random token that the preview page
+# posts back, so concurrent uploads on any worker never see each other's files
+UPLOAD_TOKEN_PATTERN = re.compile(r"[0-9a-f]{32}")
+maintenance_thread = None
+
+
+def create_upload_folder():
+    token = uuid.uuid4().hex
+    upload_folder = os.path.join(app.config["UPLOAD_FOLDER"], "staging", token)
+    os.makedirs(upload_folder)
+    return token, upload_folder
+
+
+# the staging folder of an upload token, None when the token is malformed or the upload is gone
+def get_upload_folder(token):
+    if not UPLOAD_TOKEN_PATTERN.fullmatch(token or ""):
+        return None
+    upload_folder = os.path.join(app.config["UPLOAD_FOLDER"], "staging", token)
+    return upload_folder if os.path.isdir(upload_folder) else None
+
+
+# the folders under uploads/<kind> older than the upload ttl
+def expired_upload_folders(kind):
+    parent = os.path.join(app.config["UPLOAD_FOLDER"], kind)
+    expires = time.time() - app.config['UPLOAD_TTL']
+    try:
+        folders = os.listdir(parent)
+    except OSError:
+        return []
+    expired = []
+    for folder in folders:
+        try:
+            if os.path.getmtime(os.path.join(parent, folder)) < expires:
+                expired.append(folder)
+        except OSError:
+            pass
+    return expired
+
+
+# removes staged uploads that were never imported once they are older than the upload ttl, and the folders of jobs
+# that are no longer queued or running, which a job removes itself unless its worker died under it
+def remove_expired_uploads():
+    for folder in expired_upload_folders("staging"):
+        shutil.rmtree(os.path.join(app.config["UPLOAD_FOLDER"], "staging", folder), ignore_errors=True)
+
+    job_folders = expired_upload_folders("jobs")
+    if job_folders:
+        active = set(db.session.execute(text("SELECT id FROM import_jobs WHERE id = ANY(:ids) "
+                                             "AND status IN ('queued', 'running')"),
+                                        {"ids": job_folders}).scalars())
+        for folder in job_folders:
+            if folder not in active:
+                shutil.rmtree(os.path.join(app.config["UPLOAD_FOLDER"], "jobs", folder), ignore_errors=True)
+
+
+# removes expired uploads, prunes the change log and folds the rollup deltas every UPLOAD_CLEANUP_INTERVAL seconds
+def maintenance_loop():
+    while True:
+        with app.app_context():
+            try:
+                remove_expired_uploads()
+                prune_record_changes()
+                fold_rollups()
+            except DBAPIError:
+                db.session.rollback()
+                app.logger.exception("could not clean up the uploads, prune the change log or fold the rollups")
+            finally:
+                db.session.remove()
+        time.sleep(app.config['UPLOAD_CLEANUP_INTERVAL'])
+
+
+# starts the maintenance thread of this worker when it boots (or on its first upload when it was not started
+# through gunicorn.conf.py), so it is never inherited through a fork
+def start_maintenance():
+    global maintenance_thread
+    if maintenance_thread is None:
+        maintenance_thread = threading.Thread(target=maintenance_loop, name="pycrum-maintenance", daemon=True)
+        maintenance_thread.start()
+
+
+# moves the staged upload to a job folder and queues the import, returns the job id. the folder is moved in one
+# rename, so submitting the same upload twice finds it gone the second time
+def submit_import_job(shapefile, layer, mode):
+    job_id = uuid.uuid4().hex
+    job_folder = os.path.join(app.config["UPLOAD_FOLDER"], "jobs", job_id)
+    os.makedirs(os.path.dirname(job_folder), exist_ok=True)
+    os.replace(os.path.dirname(shapefile), job_folder)
+
+    db.session.add(ImportJob(id=job_id, layer=layer, mode=mode, status="queued", created_at=datetime.utcnow(),
+                             owner=import_job_owner()))
+    db.session.commit()
+
+    get_import_executor().submit(run_import_job, job_id, job_folder,
+                                 os.path.join(job_folder, os.path.basename(shapefile)), layer, mode)
+    return job_id
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# search keys typed in the record page search bar, as (table, column, kind). text fields marked "trgm" are indexed
+# for prefix and fuzzy matching as well as exact matching
+SEARCH_FIELDS = {
+    "c id": ("customers", "id", "number"),
+    "name": ("customers", "name", "trgm"),
+    "c address": ("customers", "address", "trgm"),
+    "account": ("customers", "account_number", "number"),
+    "premise": ("customers", "premise_number", "number"),
+    "number accounted": ("customers", "number_accounted", "number"),
+    "number off": ("customers", "number_off", "number"),
+    "c area": ("customers", "area", "text"),
+    "c job set": ("customers", "job_set", "text"),
+    "l id": ("lights", "id", "number"),
+    "title": ("lights", "title", "trgm"),
+    "l address": ("lights", "address", "trgm"),
+    "ptag": ("lights", "ptag", "number"),
+    "lr number": ("lights", "lr_number", "text"),
+    "status": ("lights", "status", "text"),
+}
+SEARCH_TERM_PATTERN = re.compile(r"(?i)(?:^|(?<=[\s,;]))(" +
+                                 "|".join(re.escape(key) for key in sorted(SEARCH_FIELDS, key=len, reverse=True)) +
+                                 r")\s*:")
+
+
+# b-tree indexes for every searchable column and trigram gin indexes for the ones searched by prefix or similarity
+def search_index_statements(trigram):
+    statements = []
+    for table, column, kind in SEARCH_FIELDS.values():
+        if column == "id":
+            continue
+        statements.append(f"CREATE INDEX IF NOT EXISTS idx_{table}_{column} ON {table} ({column})")
+        if kind == "trgm" and trigram:
+            statements.append(f"CREATE INDEX IF NOT EXISTS idx_{table}_{column}_trgm "
+                              f"ON {table} USING gin ({column} gin_trgm_ops)")
+    return statements
+
+
+# splits "name:smith* c area:north" into [("name", "smith*"), ("c area", "north")]
+def parse_search(search_this):
+    matches = list(SEARCH_TERM_PATTERN.finditer(search_this))
+    terms = []
+    for index, match in enumerate(matches):
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(search_this)
+        terms.append((match.group(1).lower(), search_this[match.end():end].strip().strip(",;").strip()))
+    return terms
+
+
+# a search value as literal text inside an ILIKE pattern
+def search_like_escape(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+# whether pg_trgm is installed, looked up once per worker, so one installed later is used once the workers restart.
+# init-db installs it where the database user is allowed to
+search_cache = {"trigram": None}
+
+
+def trigram_available():
+    if search_cache["trigram"] is None:
+        search_cache["trigram"] = db.session.execute(text("SELECT EXISTS (SELECT 1 FROM pg_extension "
+                                                          "WHERE extname = 'pg_trgm')")).scalar()
+    return search_cache["trigram"]
+
+
+# builds a parameterized query for the terms on one table. a value ending in * matches by prefix, a value starting
+# with ~ matches by similarity (best matches first) on trgm fields when pg_trgm is there, and by a case insensitive
+# substring everywhere else. anything else has to match exactly.
+# returns None when a number field was given something that is not a number
+def build_search_query(table, terms, limit, trigram):
+    conditions = []
+    ranking = []
+    params = {"limit": limit}
+
+    for index, (key, value) in enumerate(terms):
+        column, kind = SEARCH_FIELDS[key][1:]
+        name = f"value_{index}"
+
+        if kind == "number":
+            try:
+                params[name] = int(value)
+            except ValueError:
+                return None
+            conditions.append(f"{column} = :{name}")
+        elif value.startswith("~") and kind == "trgm" and trigram:
+            params[name] = value[1:].strip()
+            conditions.append(f"{column} % :{name}")
+            ranking.append(f"similarity({column}, :{name})")
+        elif value.startswith("~"):
+            params[name] = "%" + search_like_escape(value[1:].strip()) + "%"
+            conditions.append(f"{column} ILIKE :{name}")
+        elif value.endswith("*"):
+            params[name] = search_like_escape(value[:-1].strip()) + "%"
+            conditions.append(f"{column} ILIKE :{name}")
+        else:
+            params[name] = value
+            conditions.append(f"{column} = :{name}")
+
+    order = f"{' + '.join(ranking)} DESC, id" if ranking else "id"
+    return text(f"SELECT * FROM {table} WHERE {' AND '.join(conditions)} ORDER BY {order} LIMIT :limit"), params
+
+
+# runs the terms of a search that belong to a table, returns None when none of them do
+def run_search(table, terms):
+    table_terms = [term for term in terms if SEARCH_FIELDS[term[0]][0] == table]
+    if not table_terms:
+        return None
+
+    query = build_search_query(table, table_terms, app.config['MAX_RECORD_PAGE_SIZE'], trigram_available())
+    if query is None:
+        return []
+    return db.session.execute(*query).all()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# reads the page of a table that follows after_id, using the primary key instead of an offset so every page costs
+# the same. one extra row is read to know whether there is a next page
+def fetch_record_page(table, after_id, page_size):
+    rows = db.session.execute(text(f"SELECT * FROM {table} WHERE id > :after_id ORDER BY id LIMIT :limit"),
+                              {"after_id": after_id, "limit": page_size + 1}).all()
+    next_after_id = rows[page_size - 1][0] if len(rows) > page_size else None
+    return rows[:page_size], next_after_id
+
+
+# renders the record page for the customers page starting after c_after and the lights page starting after l_after
+def render_record_page():
+    page_size = request.args.get("page_size", app.config['RECORD_PAGE_SIZE'], type=int)
+    page_size = max(1, min(page_size, app.config['MAX_RECORD_PAGE_SIZE']))
+    c_after = request.args.get("c_after", 0, type=int)
+    l_after = request.args.get("l_after", 0, type=int)
+
+    data_cust, c_next = fetch_record_page("customers", c_after, page_size)
+    data_light, l_next = fetch_record_page("lights", l_after, page_size)
+    paging = {"page_size": page_size, "c_after": c_after, "l_after": l_after, "c_next": c_next, "l_next": l_next}
+
+    return render_template('record_page.html', data=[data_cust, data_light], paging=paging)
+
+
+# loads customers with only the columns the detail page shows, and their lights (id and title) in a second query,
+# so any number of customers costs two queries instead of one per customer plus a lazy load of its lights
+def load_customers_with_lights(customer_ids):
+    query = (select(Customer)
+             .options(load_only(Customer.id, Customer.name, Customer.address, Customer.account_number,
+                                Customer.premise_number),
+                      selectinload(Customer.lights).load_only(Light.id, Light.customer_id, Light.title))
+             .where(Customer.id.in_(customer_ids))
+             .order_by(Customer.id))
+    return db.session.execute(query).scalars().all()
+
+
+# yields the rows of a query from a server side cursor, a batch at a time
+def stream_rows(query, params=None):
+    yield from db.session.execute(text(query), params or {}, execution_options={"yield_per": 1000})
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# columns written by the exports as (column, parquet type), and the filters each layer can be exported with
+EXPORT_COLUMNS = {
+    "customers": [("id", "int"), ("name", "str"), ("address", "str"), ("account_number", "int"),
+                  ("premise_number", "int"), ("number_accounted", "int"), ("number_off", "int"), ("area", "str"),
+                  ("job_set", "str")],
+    "lights": [("id", "int"), ("customer_id", "int"), ("title", "str"), ("address", "str"), ("ptag", "int"),
+               ("lr_number", "str"), ("area", "str"), ("job_set", "str"), ("status", "str")],
+}
+EXPORT_FILTERS = {
+    "customers": ["area", "job_set"],
+    "lights": ["area", "job_set", "status"],
+}
+EXPORT_FORMATS = {
+    "geojsonl": "application/geo+json-seq",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+EXPORT_BATCH_SIZE = 10000
+
+
+# query for an export, with the geometry as geojson, wkt or wkb depending on the format
+def export_query(layer, export_format, filters):
+    geometry = {"geojsonl": "ST_AsGeoJSON(geolocation)", "csv": "ST_AsText(geolocation)",
+                "parquet": "ST_AsBinary(geolocation)"}[export_format]
+    columns = ", ".join(column for column, kind in EXPORT_COLUMNS[layer])
+    conditions = " AND ".join(f"{column} = :{column}" for column in filters) or "TRUE"
+    return f"SELECT {columns}, {geometry} AS geometry FROM {layer} WHERE {conditions} ORDER BY id"
+
+
+def export_geojsonl(layer, rows):
+    columns = [column for column, kind in EXPORT_COLUMNS[layer]]
+    lines = []
+    for row in rows:
+        properties = json.dumps(dict(zip(columns, row[:-1])))
+        lines.append(f'{{"type":"Feature","id":{row[0]},"geometry":{row[-1] or "null"},"properties":{properties}}}\n')
+        if len(lines) >= EXPORT_BATCH_SIZE:
+            yield "".join(lines)
+            lines = []
+    yield "".join(lines)
+
+
+def export_csv(layer, rows):
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column for column, kind in EXPORT_COLUMNS[layer]] + ["wkt"])
+    for index, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if index % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+# file object that hands back whatever parquet has written since the last drain, so row groups can be streamed
+class DrainableBuffer:
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+# geoparquet with the geometry as wkb, one row group per batch of rows
+def export_parquet(layer, rows):
+    types = {"int": pa.int64(), "str": pa.string()}
+    geo_metadata = {"version": "1.0.0", "primary_column": "geometry",
+                    "columns": {"geometry": {"encoding": "WKB", "geometry_types": ["Point"]}}}
+    schema = pa.schema([(column, types[kind]) for column, kind in EXPORT_COLUMNS[layer]] +
+                       [("geometry", pa.binary())], metadata={"geo": json.dumps(geo_metadata)})
+
+    buffer = DrainableBuffer()
+    writer = pq.ParquetWriter(buffer, schema)
+    batch = []
+    for row in rows:
+        # psycopg2 returns bytea columns as memoryview
+        batch.append(tuple(row[:-1]) + (bytes(row[-1]) if row[-1] is not None else None,))
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            writer.write_table(pa.Table.from_pylist([dict(zip(schema.names, item)) for item in batch], schema))
+            batch = []
+            yield buffer.drain()
+    if batch:
+        writer.write_table(pa.Table.from_pylist([dict(zip(schema.names, item)) for item in batch], schema))
+    writer.close()
+    yield buffer.drain()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# columns of the json record api and their postgres types, the location is sent as x and y. every write of a batch
+# is one statement over the records passed in as a jsonb array, all of a batch is committed or none of it
+API_COLUMNS = {layer: {column: "integer" if kind == "int" else "text" for column, kind in columns if column != "id"}
+               for layer, columns in EXPORT_COLUMNS.items()}
+
+
+# checks a batch sent to the api, returns an error message or None. new records need a location, records of a patch
+# or delete need an id, and may carry the version they were read at to only be written if nobody changed them since
+def api_batch_error(layer, records, with_id, with_columns=True):
+    if not isinstance(records, list) or not records:
+        return "the body must be a non empty json array of records"
+    if len(records) > app.config['API_BATCH_SIZE']:
+        return f"at most {app.config['API_BATCH_SIZE']} records can be sent at once"
+
+    allowed = set(API_COLUMNS[layer]) | {"x", "y"} if with_columns else set()
+    if with_id:
+        allowed = allowed | {"id", "version"}
+    ids = set()
+    for record in records:
+        if not isinstance(record, dict):
+            return "every record must be a json object"
+        unknown = set(record) - allowed
+        if unknown:
+            return f"unknown fields {', '.join(sorted(unknown))}"
+        if ("x" in record) != ("y" in record):
+            return "x and y must be sent together"
+        if with_columns and not with_id and "x" not in record:
+            return "every new record needs an x and y"
+        if "x" in record and not (isinstance(record["x"], (int, float)) and isinstance(record["y"], (int, float))
+                                  and valid_coordinates(record["x"], record["y"])):
+            return "x and y must be a longitude and latitude"
+        if with_id:
+            if not isinstance(record.get("id"), int) or record["id"] in ids:
+                return "every record needs an id of its own"
+            if not isinstance(record.get("version", 0), int):
+                return "version must be an integer"
+            ids.add(record["id"])
+    return None
+
+
+def api_create(layer, records):
+    columns = API_COLUMNS[layer]
+    definitions = ", ".join(["x float8", "y float8"] + [f"{column} {kind}" for column, kind in columns.items()])
+    return db.session.execute(text(f"INSERT INTO {layer} (geolocation, {', '.join(columns)}) "
+                                   f"SELECT ST_MakePoint(record.x, record.y), "
+                                   f"{', '.join('record.' + column for column in columns)} "
+                                   f"FROM jsonb_to_recordset(CAST(:records AS jsonb)) AS record({definitions}) "
+                                   f"RETURNING id, version"),
+                              {"records": json.dumps(records)}).all()
+
+
+# only the fields sent with a record are written, the others keep their value
+def api_patch(layer, records):
+    assignments = [f"{column} = CASE WHEN record.data ? '{column}' THEN CAST(record.data->>'{column}' AS {kind}) "
+                   f"ELSE {layer}.{column} END" for column, kind in API_COLUMNS[layer].items()]
+    assignments.append(f"geolocation = CASE WHEN record.data ? 'x' THEN ST_MakePoint("
+                       f"CAST(record.data->>'x' AS float8), CAST(record.data->>'y' AS float8)) "
+                       f"ELSE {layer}.geolocation END")
+    return db.session.execute(text(f"UPDATE {layer} SET {', '.join(assignments)} "
+                                   f"FROM jsonb_array_elements(CAST(:records AS jsonb)) AS record(data) "
+                                   f"WHERE {layer}.id = CAST(record.data->>'id' AS integer) "
+                                   f"AND (NOT record.data ? 'version' "
+                                   f"OR {layer}.version = CAST(record.data->>'version' AS integer)) "
+                                   f"RETURNING {layer}.id, {layer}.version"),
+                              {"records": json.dumps(records)}).all()
+
+
+# lights of deleted customers are unlinked first, as deleting a customer through the orm does
+def api_delete(layer, records):
+    rows = db.session.execute(text(f"SELECT {layer}.id FROM {layer} "
+                                   f"JOIN jsonb_array_elements(CAST(:records AS jsonb)) AS record(data) "
+                                   f"ON {layer}.id = CAST(record.data->>'id' AS integer) "
+                                   f"WHERE NOT record.data ? 'version' "
+                                   f"OR {layer}.version = CAST(record.data->>'version' AS integer) "
+                                   f"FOR UPDATE OF {layer}"),
+                              {"records": json.dumps(records)}).all()
+    ids = [row.id for row in rows]
+    if layer == "customers":
+        db.session.execute(text("UPDATE lights SET customer_id = NULL WHERE customer_id = ANY(:ids)"), {"ids": ids})
+    db.session.execute(text(f"DELETE FROM {layer} WHERE id = ANY(:ids)"), {"ids": ids})
+    return [(record_id, None) for record_id in ids]
+
+
+# runs one batch operation and logs its changes for the map caches. a record that was not found or whose version
+# no longer matches rolls the whole batch back, the response names them with their current version
+def run_api_batch(layer, operation, records, conflict_status=409):
+    try:
+        rows = operation(layer, records)
+
+        written = {row[0] for row in rows}
+        unmatched = [record["id"] for record in records if "id" in record and record["id"] not in written]
+        if unmatched:
+            db.session.rollback()
+            current = dict(db.session.execute(text(f"SELECT id, version FROM {layer} WHERE id = ANY(:ids)"),
+                                              {"ids": unmatched}).all())
+            conflicts = [{"id": record_id, "version": current[record_id]}
+                         for record_id in unmatched if record_id in current]
+            status = conflict_status if conflicts else 404
+            return jsonify(error="some records were not found or have changed", conflicts=conflicts,
+                           missing=[record_id for record_id in unmatched if record_id not in current]), status
+
+        record_changes(layer, [row[0] for row in rows])
+        db.session.commit()
+    except IntegrityError as error:
+        db.session.rollback()
+        return jsonify(error=str(error.orig).strip()), 409
+    except DBAPIError as error:
+        db.session.rollback()
+        return jsonify(error=str(error.orig).strip()), 400
+
+    return jsonify(records=[{"id": record_id, "version": version} for record_id, version in rows])
+
+
+def api_record_columns(layer):
+    return f"id, ST_X(geolocation) AS x, ST_Y(geolocation) AS y, {', '.join(API_COLUMNS[layer])}, version"
+
+
+# the version a single record request was made against, from its If-Match header
+def if_match_version():
+    for etag in request.if_match.as_set():
+        return int(etag) if etag.isdigit() else -1
+    return None
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 # ----------------------------------------------------------------------------------------------------------------------
 @app.route('/')
 def root():
-    # for when database needs to be created from Models
-    db.create_all()
+    return render_template('home_page.html')
 
-    # to clear any previously uploaded files
-    for remove_file in os.listdir(os.path.join(app.config["UPLOAD_FOLDER"])):
-        file_path = os.path.join(os.path.join(app.config["UPLOAD_FOLDER"]), remove_file)
-        if os.path.isfile(file_path):
-            os.remove(file_path)
 
-    return render_template('home_page.html')
+# uploads over MAX_CONTENT_LENGTH are refused before any of the files are saved
+@app.errorhandler(413)
+def upload_too_large(error):
+    flash(f"Uploads are limited to {app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB")
+    return redirect(url_for('root'))
 
 
 # uploads files to server from local storage via stream form and previews content for confirmation
@@ -167,28 +2383,34 @@ def upload():
     file_type = request.form.get("file_type")
 
     if len(files) >= 7:
+        start_maintenance()
+        token, upload_folder = create_upload_folder()
+
+        # each file is streamed to disk in chunks rather than read into memory
         for file in files:
             filename = secure_filename(file.filename)
+            if filename == "":
+                continue
             if ".shp" in filename and ".xml" not in filename:
                 shapefile = filename
-            file.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
+            file.save(os.path.join(upload_folder, filename))
 
-        if shapefile != "":
-            gdf = gpd.read_file("uploads/" + shapefile)
+        if shapefile != "" and file_type in ("Customer", "Light"):
+            # only the first ten features and the previewed columns are read from the file
+            layer = file_type.lower() + "s"
+            columns = SHAPEFILE_PREVIEW_COLUMNS[layer]
+            gdf = read_shapefile(os.path.join(upload_folder, shapefile), columns=columns, count=10, geometry=False)
             try:
-                if file_type == "Customer":
-                    gdf_subset = gdf.loc[:9, ["Customer_N", "Service_Ad", "Account_Nu", "Premise_Nu"]]
-                    table = gdf_subset.to_html(classes="table table-striped")
-                    return render_template('upload_page.html', data=[table, "customer"])
-                if file_type == "Light":
-                    gdf_subset = gdf.loc[:9, ["Status", "Title", "PTAG", "LR_NUMBER"]]
-                    table = gdf_subset.to_html(classes="table table-striped")
-                    return render_template('upload_page.html', data=[table, "light"])
+                gdf_subset = gdf.loc[:9, columns]
+                table = gdf_subset.to_html(classes="table table-striped")
+                return render_template('upload_page.html', data=[table, file_type.lower(), token])
             except KeyError:
+                shutil.rmtree(upload_folder, ignore_errors=True)
                 return redirect(url_for('root'))
 
         # there was not a shape file in the uploaded files
         else:
+            shutil.rmtree(upload_folder, ignore_errors=True)
             return redirect(url_for('root'))
 
     # files did not contain enough information for the shape file to build the data set
@@ -200,103 +2422,66 @@ def upload():
 # creates new records from uploaded shape file, and then removes the files from database
 @app.route('/upload_page', methods=['GET', 'POST'])
 def upload_page():
-    # get shapefile from uploaded folder
+    # get shapefile from the folder of the previewed upload
     shapefile = ""
-    for file in os.listdir(os.path.join(app.config["UPLOAD_FOLDER"])):
-        filename = os.path.join(os.path.join(app.config["UPLOAD_FOLDER"]), file)
-        if ".shp" in str(filename) and ".xml" not in str(filename):
-            shapefile = filename
+    upload_folder = get_upload_folder(request.form.get("upload_token"))
+    if upload_folder is not None:
+        for file in os.listdir(upload_folder):
+            filename = os.path.join(upload_folder, file)
+            if ".shp" in str(filename) and ".xml" not in str(filename):
+                shapefile = filename
 
-    # if there is a shapefile
+    # if there is a shapefile, import it in the background and show the progress of the job
     if shapefile != "":
-        gdf = gpd.read_file(shapefile)
         file_type = request.form.get("file_type")
 
-        if file_type == "customer":
-            # default values
-            location = 0
-            name = ""
-            address = ""
-            account = 0
-            premise = 0
-            num_acc = 0
-            num_ina = 0
-            area = ""
-            job_set = ""
-
-            # replace default values with values from shape file if they exist
-            for index, row in gdf.iterrows():
-                if row["geometry"]:
-                    location = row["geometry"]
-                if row["Customer_N"]:
-                    name = row["Customer_N"]
-                if row["Service_Ad"]:
-                    address = row["Service_Ad"]
-                if row["Account_Nu"]:
-                    account = row["Account_Nu"]
-                if row["Premise_Nu"]:
-                    premise = row["Premise_Nu"]
-                if row["Number_Act"]:
-                    num_acc = row["Number_Act"]
-                if row["Number_Ina"]:
-                    num_ina = row["Number_Ina"]
-                if row["AREA"]:
-                    area = row["AREA"]
-                if row["JOBSET"]:
-                    job_set = row["JOBSET"]
-
-                new_record = Customer(geolocation='POINT(' + str(location.x) + ' ' + str(location.y) + ')', name=name,
-                                      address=address, account_number=account, premise_number=premise,
-                                      number_accounted=num_acc, number_off=num_ina, area=area,
-                                      job_set=job_set)
-
-                db.session.add(new_record)
-                db.session.commit()
-
-        if file_type == "light":
-            # default values
-            location = 0
-            title = ""
-            address = ""
-            ptag = 0
-            lr_number = 0
-            area = ""
-            job_set = ""
-            status = ""
-
-            # replace default values with values from shape file if they exist
-            for index, row in gdf.iterrows():
-                if row["geometry"]:
-                    location = row["geometry"]
-                if row["Customer_N"]:
-                    title = row["Title"]
-                if row["Service_Ad"]:
-                    ptag = row["PTAG"]
-                if row["Account_Nu"]:
-                    lr_number = row["LR_NUMBER"]
-                if row["AREA"]:
-                    area = row["AREA"]
-                if row["JOBSET"]:
-                    job_set = row["JOBSET"]
-                if row["Status"]:
-                    status = row["Status"]
-
-                new_record = Light(geolocation='POINT(' + str(location.x) + ' ' + str(location.y) + ')',
-                                   customer_id=1, title=title, address=address, ptag=ptag,
-                                   lr_number=lr_number, area=area, job_set=job_set, status=status, )
-
-                db.session.add(new_record)
-                db.session.commit()
-
-        # remove files once complete
-        for remove_file in os.listdir(os.path.join(app.config["UPLOAD_FOLDER"])):
-            file_path = os.path.join(os.path.join(app.config["UPLOAD_FOLDER"]), remove_file)
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-
-        flash("Shapefile saved to database.", "success")
+        mode = "upsert" if request.form.get("mode") == "upsert" else "append"
+
+        if file_type in ("customer", "light"):
+            try:
+                job_id = submit_import_job(shapefile, file_type + "s", mode)
+            except FileNotFoundError:
+                # the same upload was submitted again, or expired, while this request was on its way
+                return redirect(url_for('root'))
+            return redirect(url_for('import_job_page', job_id=job_id))
+
+    return redirect(url_for('root'))
+
 
+# progress page of a background shapefile import
+@app.route('/import_jobs/<job_id>')
+def import_job_page(job_id):
+    job = db.session.get(ImportJob, job_id)
+    if job is None:
         return redirect(url_for('root'))
+    return render_template('import_job_page.html', job=job)
+
+
+# status of a background shapefile import, polled by the progress page
+@app.route('/api/import_jobs/<job_id>')
+def import_job_status(job_id):
+    job = db.session.get(ImportJob, job_id)
+    if job is None:
+        return jsonify(error="unknown job"), 404
+
+    return jsonify(id=job.id, layer=job.layer, mode=job.mode, status=job.status, rows_total=job.rows_total,
+                   rows_processed=job.rows_processed, rows_changed=job.rows_changed,
+                   rows_per_second=job.rows_per_second, error=job.error,
+                   cancel_requested=job.cancel_requested, created_at=job.created_at.isoformat(),
+                   finished_at=job.finished_at.isoformat() if job.finished_at else None)
+
+
+# asks a queued or running import to stop, the job rolls back everything it has copied so far
+@app.route('/import_jobs/<job_id>/cancel', methods=['POST'])
+def cancel_import_job(job_id):
+    job = db.session.get(ImportJob, job_id)
+    if job is not None and job.status in ("queued", "running"):
+        job.cancel_requested = True
+        db.session.commit()
+
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(cancel_requested=job is not None)
+    return redirect(url_for('import_job_page', job_id=job_id))
 
 
 # app routes below correlate to map view
@@ -307,11 +2492,149 @@ def map_page():
     return render_template('map_page.html')
 
 
-# creates the map to be rendered into an iFrame on the map page
+# creates the map to be rendered into an iFrame on the map page. the saved map is sent as it is, already
+# compressed, and its digest is the etag so a browser holding the current map is answered with a 304
 @app.route('/map_view')
 def map_view():
-    generate_shape_map()
-    return render_template('map.html')
+    digest, variants = get_cached_map()
+    if request.if_none_match.contains(digest):
+        return Response(status=304, headers={"ETag": f'"{digest}"', "Vary": "Accept-Encoding"})
+
+    encoding = request.accept_encodings.best_match([encoding for encoding in ("br", "gzip") if encoding in variants],
+                                                   default="identity")
+    response = Response(variants[encoding], mimetype="text/html")
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    response.set_etag(digest)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+# map that loads only the features inside the current viewport from the feature api
+@app.route('/map_live')
+def map_live():
+    return render_template('viewport_map.html', layers=list(MAP_LAYERS))
+
+
+# returns the customers and lights (or clusters of them) inside a bounding box as geojson,
+# e.g. /api/features?bbox=-87,33,-86,34&zoom=12
+@app.route('/api/features')
+def api_features():
+    bbox = parse_bbox(request.args.get("bbox"))
+    zoom = request.args.get("zoom", type=int)
+    layers = request.args.get("layers", ",".join(MAP_LAYERS)).split(",")
+
+    if bbox is None:
+        return jsonify(error="bbox must be min_x,min_y,max_x,max_y"), 400
+    if any(layer not in MAP_LAYERS for layer in layers):
+        return jsonify(error="unknown layer"), 400
+
+    features = []
+    truncated = False
+    point_store.sync()
+    for layer in layers:
+        # zoomed out views with many points get the precomputed clusters instead of the individual features
+        if zoom is not None and zoom <= CLUSTER_MAX_ZOOM:
+            clusters = cluster_index.clusters_in_bbox(layer, zoom, bbox)
+            if sum(cluster["properties"]["count"] for cluster in clusters) > CLUSTER_RAW_FEATURE_LIMIT:
+                features.extend(clusters)
+                continue
+
+        layer_features, layer_truncated = query_features_in_bbox(layer, bbox)
+        features.extend(layer_features)
+        truncated = truncated or layer_truncated
+
+    return jsonify(type="FeatureCollection", features=features, zoom=zoom, truncated=truncated)
+
+
+# the point a nearby lookup starts from: x and y, or the location of the record named by customer_id or light_id
+def nearby_origin():
+    for layer, argument in (("customers", "customer_id"), ("lights", "light_id")):
+        record_id = request.args.get(argument, type=int)
+        if record_id is not None:
+            point = point_store.points[layer].get(record_id)
+            return None if point is None else point[:2]
+
+    x = request.args.get("x", type=float)
+    y = request.args.get("y", type=float)
+    if x is None or y is None or not valid_coordinates(x, y):
+        return None
+    return x, y
+
+
+def nearby_feature(layer, result):
+    distance, record_id, x, y, status = result
+    properties = {"layer": layer, "id": record_id, "distance": round(distance, 2)}
+    if layer == "lights":
+        properties["status"] = status
+    return {"type": "Feature", "geometry": {"type": "Point", "coordinates": [x, y]}, "properties": properties}
+
+
+# customers and lights within radius meters of a point, nearest first, answered from the in memory index,
+# e.g. /api/nearby?x=-86.8&y=33.5&radius=200 or /api/nearby?customer_id=42&layers=lights
+@app.route('/api/nearby')
+def api_nearby():
+    radius = request.args.get("radius", 200, type=float)
+    layers = request.args.get("layers", ",".join(MAP_LAYERS)).split(",")
+    if any(layer not in MAP_LAYERS for layer in layers):
+        return jsonify(error="unknown layer"), 400
+    if not 0 <= radius <= 100000:
+        return jsonify(error="radius must be between 0 and 100000 meters"), 400
+
+    point_store.sync(max_age=app.config['NEARBY_SYNC_INTERVAL'])
+    origin = nearby_origin()
+    if origin is None:
+        return jsonify(error="x and y, customer_id or light_id must name a location"), 400
+
+    features = []
+    truncated = False
+    for layer in layers:
+        results = nearby_index.within(layer, origin[0], origin[1], radius)
+        truncated = truncated or len(results) > NEARBY_MAX_RESULTS
+        features.extend(nearby_feature(layer, result) for result in results[:NEARBY_MAX_RESULTS])
+
+    features.sort(key=lambda feature: feature["properties"]["distance"])
+    return jsonify(type="FeatureCollection", features=features, truncated=truncated)
+
+
+# the records of a layer nearest to a point, e.g. /api/nearest?layer=lights&customer_id=42&count=3
+@app.route('/api/nearest')
+def api_nearest():
+    layer = request.args.get("layer", "lights")
+    count = request.args.get("count", 1, type=int)
+    max_distance = request.args.get("max_distance", type=float)
+    if layer not in MAP_LAYERS:
+        return jsonify(error="unknown layer"), 400
+    if not 1 <= count <= NEARBY_MAX_RESULTS:
+        return jsonify(error=f"count must be between 1 and {NEARBY_MAX_RESULTS}"), 400
+
+    point_store.sync(max_age=app.config['NEARBY_SYNC_INTERVAL'])
+    origin = nearby_origin()
+    if origin is None:
+        return jsonify(error="x and y, customer_id or light_id must name a location"), 400
+
+    results = nearby_index.nearest(layer, origin[0], origin[1], count, max_distance)
+    return jsonify(type="FeatureCollection", features=[nearby_feature(layer, result) for result in results])
+
+
+# mapbox vector tile with a customers and a lights layer, served from the tile cache when it has not changed
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.pbf')
+def tiles(z, x, y):
+    if z > TILE_MAX_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return jsonify(error="tile out of range"), 404
+
+    point_store.sync()
+    key = (z, x, y)
+    tile = tile_cache.get(key)
+
+    if tile is None:
+        tile = render_tile(z, x, y)
+        tile_cache.put(key, tile)
+        # evicts the tile again if a change was committed while it was rendering
+        point_store.sync()
+
+    return Response(tile, mimetype="application/vnd.mapbox-vector-tile")
 
 
 # shows more information for record when clicked on from map link for updating
@@ -343,8 +2666,7 @@ def update_record():
             if u_premise != "":
                 updated_record.premise_number = int(u_premise)
 
-            db.session.commit()
-            generate_shape_map()
+            save_form_record("customers", updated_record)
 
             return render_template('map_page.html')
 
@@ -370,8 +2692,7 @@ def update_record():
             if u_status != "":
                 updated_record.status = u_status
 
-            db.session.commit()
-            generate_shape_map()
+            save_form_record("lights", updated_record)
 
             return render_template('map_page.html')
 
@@ -381,15 +2702,136 @@ def update_record():
         return render_template('map_page.html')
 
 
+# app routes below correlate to the summary dashboard
+# ----------------------------------------------------------------------------------------------------------------------
+# counts per area, job set and status read from the rollup tables
+@app.route('/summary')
+def summary_page():
+    return render_template('summary_page.html', data=load_summary())
+
+
+@app.route('/api/summary')
+def summary():
+    return jsonify(load_summary())
+
+
+# app routes below correlate to data export
+# ----------------------------------------------------------------------------------------------------------------------
+# streams a layer as newline delimited geojson, csv with wkt or geoparquet, e.g. /export/lights.csv?status=OUT.
+# the etag is made from the data version and the filters, so an unchanged export is answered with a 304
+@app.route('/export/<layer>.<export_format>')
+def export(layer, export_format):
+    if layer not in EXPORT_COLUMNS or export_format not in EXPORT_FORMATS:
+        return jsonify(error="unknown layer or format"), 404
+    if export_format == "parquet" and not pq.available():
+        return jsonify(error="geoparquet exports need pyarrow installed"), 501
+
+    filters = {column: request.args[column] for column in EXPORT_FILTERS[layer] if column in request.args}
+    filter_key = hashlib.md5(json.dumps(filters, sort_keys=True).encode()).hexdigest()[:12]
+    etag = f"{layer}-{export_format}-{get_data_version()}-{filter_key}"
+
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+    writer = {"geojsonl": export_geojsonl, "csv": export_csv, "parquet": export_parquet}[export_format]
+    rows = stream_rows(export_query(layer, export_format, filters), filters)
+    response = Response(stream_with_context(writer(layer, rows)), mimetype=EXPORT_FORMATS[export_format])
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["Content-Disposition"] = f"attachment; filename={layer}.{export_format}"
+    return response
+
+
+# app routes below correlate to the json record api
+# ----------------------------------------------------------------------------------------------------------------------
+# a page of records ordered by id, e.g. /api/lights?after_id=1000&limit=500. a json array of records is created
+# with POST, patched with PATCH and deleted with DELETE, e.g. PATCH [{"id": 7, "version": 3, "status": "OUT"}]
+@app.route('/api/<any(customers, lights):layer>', methods=['GET', 'POST', 'PATCH', 'DELETE'])
+def api_records(layer):
+    if request.method == 'GET':
+        after_id = request.args.get("after_id", 0, type=int)
+        limit = max(1, min(request.args.get("limit", app.config['RECORD_PAGE_SIZE'], type=int),
+                           app.config['MAX_RECORD_PAGE_SIZE']))
+        rows = db.session.execute(text(f"SELECT {api_record_columns(layer)} FROM {layer} WHERE id > :after_id "
+                                       f"ORDER BY id LIMIT :limit"),
+                                  {"after_id": after_id, "limit": limit + 1}).mappings().all()
+        return jsonify(records=[dict(row) for row in rows[:limit]],
+                       next_after_id=rows[limit - 1]["id"] if len(rows) > limit else None)
+
+    records = request.get_json(silent=True)
+    if request.method == 'DELETE' and isinstance(records, list):
+        records = [{"id": record} if isinstance(record, int) else record for record in records]
+
+    error = api_batch_error(layer, records, with_id=request.method != 'POST', with_columns=request.method != 'DELETE')
+    if error is not None:
+        return jsonify(error=error), 400
+
+    operation = {"POST": api_create, "PATCH": api_patch, "DELETE": api_delete}[request.method]
+    return run_api_batch(layer, operation, records)
+
+
+# a single record, its version is the etag. PATCH and DELETE with an If-Match header only change the record if it
+# is still at that version
+@app.route('/api/<any(customers, lights):layer>/<int:record_id>', methods=['GET', 'PATCH', 'DELETE'])
+def api_record(layer, record_id):
+    if request.method == 'GET':
+        row = db.session.execute(text(f"SELECT {api_record_columns(layer)} FROM {layer} WHERE id = :id"),
+                                 {"id": record_id}).mappings().first()
+        if row is None:
+            return jsonify(error="record not found"), 404
+        if request.if_none_match.contains(str(row["version"])):
+            return Response(status=304, headers={"ETag": f'"{row["version"]}"'})
+        response = jsonify(dict(row))
+        response.set_etag(str(row["version"]))
+        return response
+
+    record = request.get_json(silent=True) if request.method == 'PATCH' else {}
+    if not isinstance(record, dict):
+        return jsonify(error="the body must be a json object"), 400
+    record = dict(record, id=record_id)
+    version = if_match_version()
+    if version is not None:
+        record["version"] = version
+
+    error = api_batch_error(layer, [record], with_id=True, with_columns=request.method == 'PATCH')
+    if error is not None:
+        return jsonify(error=error), 400
+
+    response = run_api_batch(layer, api_patch if request.method == 'PATCH' else api_delete, [record],
+                             conflict_status=412)
+    if request.method == 'PATCH' and not isinstance(response, tuple):
+        response.set_etag(str(response.json["records"][0]["version"]))
+    return response
+
+
 # app routes below correlate to record view
 # ----------------------------------------------------------------------------------------------------------------------
-# record page that shows all record information from a database query
+# record page that shows one page of customers and one page of lights, paged by id
 @app.route('/record_page')
 def record_page():
-    data_cust = db.session.execute(text("SELECT * FROM customers ORDER BY id"))
-    data_light = db.session.execute(text("SELECT * FROM lights ORDER BY id"))
-    data = [data_cust, data_light]
-    return render_template('record_page.html', data=data)
+    return render_record_page()
+
+
+# every record on one page, streamed to the client while the rows are read from server side cursors
+@app.route('/record_page/all')
+def record_page_all():
+    data = [stream_rows("SELECT * FROM customers ORDER BY id"), stream_rows("SELECT * FROM lights ORDER BY id")]
+    return Response(stream_template('record_page.html', data=data))
+
+
+# commits a record added or edited through the forms. when its import key is taken by another record the change is
+# rolled back and the page shows why instead of failing. returns whether it was saved
+def save_form_record(layer, record):
+    try:
+        db.session.flush()
+        record_change(layer, record.id)
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+        key = " and ".join(column.replace("_", " ") for column in UPSERT_KEYS[layer])
+        flash(f"Not saved, another {layer[:-1]} already has this {key}")
+        return False
 
 
 # add record from the records page
@@ -420,17 +2862,19 @@ def add_record():
             latitude = request.form.get('Latitude')
             longitude = request.form.get('Longitude')
 
-            new_record = Customer(geolocation='POINT(' + str(latitude) + ' ' + str(longitude) + ')', name=name,
+            geolocation = form_point(longitude, latitude)
+            if geolocation is None:
+                flash(FORM_POINT_INVALID)
+                return render_record_page()
+
+            new_record = Customer(geolocation=geolocation, name=name,
                                   address=address, account_number=account, premise_number=premise,
                                   number_accounted=number_accounted, number_off=number_off, area=area,
                                   job_set=job_set)
             db.session.add(new_record)
-            db.session.commit()
+            save_form_record("customers", new_record)
 
-            data_cust = db.session.execute(text("SELECT * FROM customers ORDER BY id"))
-            data_light = db.session.execute(text("SELECT * FROM lights ORDER BY id"))
-            data = [data_cust, data_light]
-            return render_template('record_page.html', data=data)
+            return render_record_page()
 
         if add == "light":
             customer_id = request.form.get("Customer_ID")
@@ -444,27 +2888,23 @@ def add_record():
             latitude = request.form.get('L_Latitude')
             longitude = request.form.get('L_Longitude')
 
-            new_record = Light(geolocation='POINT(' + str(latitude) + ' ' + str(longitude) + ')',
+            geolocation = form_point(longitude, latitude)
+            if geolocation is None:
+                flash(FORM_POINT_INVALID)
+                return render_record_page()
+
+            new_record = Light(geolocation=geolocation,
                                customer_id=customer_id, title=title, address=address, ptag=ptag,
                                lr_number=lr_number, area=area, job_set=job_set, status=status, )
             db.session.add(new_record)
-            db.session.commit()
+            save_form_record("lights", new_record)
 
-            data_cust = db.session.execute(text("SELECT * FROM customers ORDER BY id"))
-            data_light = db.session.execute(text("SELECT * FROM lights ORDER BY id"))
-            data = [data_cust, data_light]
-            return render_template('record_page.html', data=data)
+            return render_record_page()
 
-        data_cust = db.session.execute(text("SELECT * FROM customers ORDER BY id"))
-        data_light = db.session.execute(text("SELECT * FROM lights ORDER BY id"))
-        data = [data_cust, data_light]
-        return render_template('record_page.html', data=data)
+        return render_record_page()
 
     else:
-        data_cust = db.session.execute(text("SELECT * FROM customers ORDER BY id"))
-        data_light = db.session.execute(text("SELECT * FROM lights ORDER BY id"))
-        data = [data_cust, data_light]
-        return render_template('record_page.html', data=data)
+        return render_record_page()
 
 
 # route that shows the edit record page from the records page
@@ -473,9 +2913,9 @@ def edit_record_page():
     if request.form.get("editing_customer") == "yes":
         e_id = request.form.get("edit_id")
         e_location = request.form.get("edit_location")
-        shapely_point = wkb.loads(e_location)
-        e_lat = shapely_point.x
-        e_lon = shapely_point.y
+        shapely_point = shapely.from_wkb(e_location)
+        e_lat = shapely_point.y
+        e_lon = shapely_point.x
         e_name = request.form.get("edit_name")
         e_address = request.form.get('edit_address')
         e_account = request.form.get('edit_account')
@@ -493,9 +2933,9 @@ def edit_record_page():
         e_l_id = request.form.get("edit_l_id")
         e_c_id = request.form.get("edit_customer_id")
         e_l_location = request.form.get("edit_l_location")
-        shapely_point = wkb.loads(e_l_location)
-        e_l_lat = shapely_point.x
-        e_l_lon = shapely_point.y
+        shapely_point = shapely.from_wkb(e_l_location)
+        e_l_lat = shapely_point.y
+        e_l_lon = shapely_point.x
         e_title = request.form.get("edit_title")
         e_l_address = request.form.get('edit_l_address')
         e_ptag = request.form.get('edit_ptag')
@@ -528,8 +2968,13 @@ def edit_record():
         edited_record = db.session.query(Customer).filter(Customer.id == new_e_id).first()
 
         if edited_record:
-            if new_e_latitude != "" and new_e_longitude != "":
-                edited_record.geolocation = 'POINT(' + str(new_e_latitude) + ' ' + str(new_e_longitude) + ')'
+            # left empty the location stays as it is
+            if new_e_latitude or new_e_longitude:
+                geolocation = form_point(new_e_longitude, new_e_latitude)
+                if geolocation is None:
+                    flash(FORM_POINT_INVALID)
+                    return render_record_page()
+                edited_record.geolocation = geolocation
             if new_e_name != "":
                 edited_record.name = new_e_name
             if new_e_address != "":
@@ -547,12 +2992,9 @@ def edit_record():
             if new_e_job_set != "":
                 edited_record.job_set = new_e_job_set
 
-            db.session.commit()
+            save_form_record("customers", edited_record)
 
-            data_cust = db.session.execute(text("SELECT * FROM customers ORDER BY id"))
-            data_light = db.session.execute(text("SELECT * FROM lights ORDER BY id"))
-            data = [data_cust, data_light]
-            return render_template('record_page.html', data=data)
+            return render_record_page()
 
     if request.form.get("new_edit_type") == "light":
         new_e_l_id = request.form.get("new_edit_l_id")
@@ -569,8 +3011,13 @@ def edit_record():
         edited_record = db.session.query(Light).filter(Light.id == new_e_l_id).first()
 
         if edited_record:
-            if new_e_l_latitude != "" and new_e_l_longitude != "":
-                edited_record.geolocation = 'POINT(' + str(new_e_l_latitude) + ' ' + str(new_e_l_longitude) + ')'
+            # left empty the location stays as it is
+            if new_e_l_latitude or new_e_l_longitude:
+                geolocation = form_point(new_e_l_longitude, new_e_l_latitude)
+                if geolocation is None:
+                    flash(FORM_POINT_INVALID)
+                    return render_record_page()
+                edited_record.geolocation = geolocation
             if new_e_title != "":
                 edited_record.title = new_e_title
             if new_e_l_address != "":
@@ -586,12 +3033,9 @@ def edit_record():
             if new_e_status != "":
                 edited_record.status = new_e_status
 
-            db.session.commit()
+            save_form_record("lights", edited_record)
 
-            data_cust = db.session.execute(text("SELECT * FROM customers ORDER BY id"))
-            data_light = db.session.execute(text("SELECT * FROM lights ORDER BY id"))
-            data = [data_cust, data_light]
-            return render_template('record_page.html', data=data)
+            return render_record_page()
 
 
 # route that shows the delete record page for confirming deletion of a record
@@ -627,11 +3071,9 @@ def delete_record():
 
         if deleting_record:
             db.session.delete(deleting_record)
+            record_change("customers", deleting_record.id)
             db.session.commit()
-            data_cust = db.session.execute(text("SELECT * FROM customers ORDER BY id"))
-            data_light = db.session.execute(text("SELECT * FROM lights ORDER BY id"))
-            data = [data_cust, data_light]
-            return render_template('record_page.html', data=data)
+            return render_record_page()
 
     if request.form.get("delete_type") == "light":
         delete_id = request.form.get("delete_confirm_id")
@@ -639,122 +3081,32 @@ def delete_record():
 
         if deleting_record:
             db.session.delete(deleting_record)
+            record_change("lights", deleting_record.id)
             db.session.commit()
-            data_cust = db.session.execute(text("SELECT * FROM customers ORDER BY id"))
-            data_light = db.session.execute(text("SELECT * FROM lights ORDER BY id"))
-            data = [data_cust, data_light]
-            return render_template('record_page.html', data=data)
+            return render_record_page()
 
 
-# route that handles deleting record by getting id from confirmation page
+# route that searches records with one or more "key: value" terms, e.g. "c area: north status: out"
 @app.route('/search_record', methods=['POST'])
 def search_record():
-    search_this = request.form.get("search_this")
-
-    if search_this.split(":")[0].lower().strip() == "c id":
-        data = db.session.execute(text(f"SELECT * FROM customers WHERE "
-                                       f"id='{search_this.split(':')[1].strip()}' ORDER BY id"))
-        data = [data, None]
-        return render_template('record_page.html', data=data)
-
-    elif search_this.split(":")[0].lower().strip() == "name":
-        data = db.session.execute(text(f"SELECT * FROM customers WHERE "
-                                       f"name='{search_this.split(':')[1].strip()}' ORDER BY id"))
-        data = [data, None]
-        return render_template('record_page.html', data=data)
-
-    elif search_this.split(":")[0].lower().strip() == "c address":
-        data = db.session.execute(text(f"SELECT * FROM customers WHERE "
-                                       f"address='{search_this.split(':')[1].strip()}' ORDER BY id"))
-        data = [data, None]
-        return render_template('record_page.html', data=data)
-
-    elif search_this.split(":")[0].lower().strip() == "account":
-        data = db.session.execute(text(f"SELECT * FROM customers WHERE "
-                                       f"account_number='{search_this.split(':')[1].strip()}' ORDER BY id"))
-        data = [data, None]
-        return render_template('record_page.html', data=data)
-
-    elif search_this.split(":")[0].lower().strip() == "premise":
-        data = db.session.execute(text(f"SELECT * FROM customers WHERE "
-                                       f"premise_number='{search_this.split(':')[1].strip()}' ORDER BY id"))
-        data = [data, None]
-        return render_template('record_page.html', data=data)
-
-    elif search_this.split(":")[0].lower().strip() == "number accounted":
-        data = db.session.execute(text(f"SELECT * FROM customers WHERE "
-                                       f"number_accounted='{search_this.split(':')[1].strip()}' ORDER BY id"))
-        data = [data, None]
-        return render_template('record_page.html', data=data)
-
-    elif search_this.split(":")[0].lower().strip() == "number off":
-        data = db.session.execute(text(f"SELECT * FROM customers WHERE "
-                                       f"number_off='{search_this.split(':')[1].strip()}' ORDER BY id"))
-        data = [data, None]
-        return render_template('record_page.html', data=data)
-
-    elif search_this.split(":")[0].lower().strip() == "c area":
-        data = db.session.execute(text(f"SELECT * FROM customers WHERE "
-                                       f"area='{search_this.split(':')[1].strip()}' ORDER BY id"))
-        data = [data, None]
-        return render_template('record_page.html', data=data)
-
-    elif search_this.split(":")[0].lower().strip() == "c job set":
-        data = db.session.execute(text(f"SELECT * FROM customers WHERE "
-                                       f"job_set='{search_this.split(':')[1].strip()}' ORDER BY id"))
-        data = [data, None]
-        return render_template('record_page.html', data=data)
-
-    elif search_this.split(":")[0].lower().strip() == "l id":
-        data = db.session.execute(text(f"SELECT * FROM lights WHERE "
-                                       f"id='{search_this.split(':')[1].strip()}' ORDER BY id"))
-        data = [None, data]
-        return render_template('record_page.html', data=data)
-
-    elif search_this.split(":")[0].lower().strip() == "title":
-        data = db.session.execute(text(f"SELECT * FROM lights WHERE "
-                                       f"title='{search_this.split(':')[1].strip()}' ORDER BY id"))
-        data = [None, data]
-        return render_template('record_page.html', data=data)
-
-    elif search_this.split(":")[0].lower().strip() == "l address":
-        data = db.session.execute(text(f"SELECT * FROM lights WHERE "
-                                       f"address='{search_this.split(':')[1].strip()}' ORDER BY id"))
-        data = [None, data]
-        return render_template('record_page.html', data=data)
-
-    elif search_this.split(":")[0].lower().strip() == "ptag":
-        data = db.session.execute(text(f"SELECT * FROM lights WHERE "
-                                       f"ptag='{search_this.split(':')[1].strip()}' ORDER BY id"))
-        data = [None, data]
-        return render_template('record_page.html', data=data)
-
-    elif search_this.split(":")[0].lower().strip() == "lr number":
-        data = db.session.execute(text(f"SELECT * FROM lights WHERE "
-                                       f"lr_number='{search_this.split(':')[1].strip()}' ORDER BY id"))
-        data = [None, data]
-        return render_template('record_page.html', data=data)
-
-    elif search_this.split(":")[0].lower().strip() == "status":
-        data = db.session.execute(text(f"SELECT * FROM lights WHERE "
-                                       f"status='{search_this.split(':')[1].strip()}' ORDER BY id"))
-        data = [None, data]
-        return render_template('record_page.html', data=data)
+    search_this = request.form.get("search_this") or ""
+    terms = parse_search(search_this)
 
-    else:
-        data_cust = db.session.execute(text("SELECT * FROM customers ORDER BY id"))
-        data_light = db.session.execute(text("SELECT * FROM lights ORDER BY id"))
-        data = [data_cust, data_light]
-        return render_template('record_page.html', data=data)
+    if not terms:
+        return render_record_page()
 
+    data = [run_search("customers", terms), run_search("lights", terms)]
+    return render_template('record_page.html', data=data)
 
-# route that handles deleting record by getting id from confirmation page
+
+# route that shows a customer and the lights linked to it
 @app.route('/show_customer', methods=['POST'])
 def show_customer():
-    show_customer_id = request.form.get("show_customer_id")
-    showing_record = db.session.query(Customer).filter(Customer.id == show_customer_id).first()
+    show_customer_id = request.form.get("show_customer_id", type=int)
+    customers = load_customers_with_lights([show_customer_id]) if show_customer_id is not None else []
 
-    if showing_record:
+    if customers:
+        showing_record = customers[0]
         s_id = show_customer_id
         s_name = showing_record.name
         s_address = showing_record.address
@@ -766,10 +3118,23 @@ def show_customer():
         return render_template('show_customer_page.html', data=show_record)
 
     else:
-        data_cust = db.session.execute(text("SELECT * FROM customers ORDER BY id"))
-        data_light = db.session.execute(text("SELECT * FROM lights ORDER BY id"))
-        data = [data_cust, data_light]
-        return render_template('record_page.html', data=data)
+        return render_record_page()
+
+
+# several customers with their lights, e.g. /api/customers/details?ids=1,2,3
+@app.route('/api/customers/details')
+def customer_details():
+    try:
+        customer_ids = [int(value) for value in request.args.get("ids", "").split(",") if value.strip()]
+    except ValueError:
+        return jsonify(error="ids must be a comma separated list of customer ids"), 400
+
+    customers = load_customers_with_lights(customer_ids)
+    return jsonify(customers=[{"id": customer.id, "name": customer.name, "address": customer.address,
+                               "account_number": customer.account_number,
+                               "premise_number": customer.premise_number,
+                               "lights": [{"id": light.id, "title": light.title} for light in customer.lights]}
+                              for customer in customers])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,275 @@
+# benchmarks the slow paths of pycrum against synthetic data and writes the results as json, e.g.
+#
+#   python benchmarks/run.py --sizes 1000 100000 --output before.json
+#   python benchmarks/run.py --sizes 1000 100000 --output after.json --compare before.json
+#
+# without --database-uri a throwaway postgres cluster is started from the local initdb/pg_ctl binaries, listening
+# only on a unix socket in a temporary folder, so nothing goes over the network. it needs postgis installed
+import argparse
+import glob
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_SIZES = [1000, 100000, 1000000]
+SEARCHES = ["name: Customer 42", "name: Customer 4*", "name: ~Custmer 42", "status: OUT",
+            "c area: Area 3 c job set: Job 5", "ptag: 42"]
+
+
+# a postgres cluster in a temporary folder, started and stopped around the benchmarks
+class LocalPostgres:
+    def __init__(self):
+        self.folder = tempfile.mkdtemp(prefix="pycrum-bench-")
+        self.data = os.path.join(self.folder, "data")
+        self.port = 54329
+
+    def binary(self, name):
+        path = shutil.which(name)
+        if path is None:
+            try:
+                bindir = subprocess.run(["pg_config", "--bindir"], capture_output=True, text=True, check=True)
+                path = os.path.join(bindir.stdout.strip(), name)
+            except (OSError, subprocess.CalledProcessError):
+                raise SystemExit(f"{name} was not found, install postgres and postgis or pass --database-uri")
+        return path
+
+    def __enter__(self):
+        subprocess.run([self.binary("initdb"), "-D", self.data, "-U", "postgres", "--auth=trust"],
+                       check=True, capture_output=True)
+        subprocess.run([self.binary("pg_ctl"), "-D", self.data, "-w", "-l", os.path.join(self.folder, "log"),
+                        "-o", f"-p {self.port} -k {self.folder} -c listen_addresses=''", "start"],
+                       check=True, capture_output=True)
+        subprocess.run([self.binary("createdb"), "-h", self.folder, "-p", str(self.port), "-U", "postgres",
+                        "pycrum"], check=True, capture_output=True)
+        subprocess.run([self.binary("psql"), "-h", self.folder, "-p", str(self.port), "-U", "postgres", "-d",
+                        "pycrum", "-c", "CREATE EXTENSION postgis"], check=True, capture_output=True)
+        return f"postgresql+psycopg2://postgres@/pycrum?host={self.folder}&port={self.port}"
+
+    def __exit__(self, *exc_info):
+        subprocess.run([self.binary("pg_ctl"), "-D", self.data, "-m", "fast", "stop"], capture_output=True)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+# the rss high water mark is process wide, on linux it is reset before every benchmark (by writing 5 to
+# /proc/self/clear_refs) so each reports its own peak. elsewhere peak_rss_delta_mb is left out and peak_rss_mb is
+# the peak of the whole run so far
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def proc_status_mb(field):
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mb():
+    peak = proc_status_mb("VmHWM")
+    return peak if peak is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+# runs function iterations times (setup is run before each one but not timed) and summarizes the timings
+def measure(name, size, function, iterations, setup=None, rows=None):
+    peak_reset = reset_peak_rss()
+    rss_before = proc_status_mb("VmRSS")
+    durations = []
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        start_time = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start_time)
+
+    mean = statistics.mean(durations)
+    result = {
+        "benchmark": name,
+        "size": size,
+        "iterations": iterations,
+        "mean_ms": round(mean * 1000, 3),
+        "p50_ms": round(percentile(durations, 0.5) * 1000, 3),
+        "p90_ms": round(percentile(durations, 0.9) * 1000, 3),
+        "p99_ms": round(percentile(durations, 0.99) * 1000, 3),
+        "max_ms": round(max(durations) * 1000, 3),
+        "ops_per_s": round(1 / mean, 3) if mean else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+    if peak_reset and rss_before is not None:
+        result["peak_rss_delta_mb"] = round(peak_rss_mb() - rss_before, 1)
+    if rows is not None:
+        result["rows_per_s"] = round(rows / mean, 1) if mean else None
+
+    print(f"{name:>16} {size:>9}  p50 {result['p50_ms']:>10.1f} ms  p90 {result['p90_ms']:>10.1f} ms  "
+          f"rss {result['peak_rss_mb']:>8.1f} MB", file=sys.stderr)
+    return result
+
+
+# drops and recreates every table and forgets the per worker caches built from the previous data
+def reset_database(app_module):
+    with app_module.app.app_context():
+        app_module.db.drop_all()
+        app_module.create_schema()
+    app_module.map_cache.update(version=None, digest=None, variants=None)
+    app_module.point_store.synced_version = None
+
+
+def check_response(response):
+    if response.status_code >= 400:
+        raise RuntimeError(f"{response.request.path} returned {response.status_code}")
+    response.get_data()
+
+
+def run_size(app_module, size, iterations, folder):
+    import synthetic
+
+    app = app_module.app
+    client = app.test_client()
+    reset_database(app_module)
+    synthetic.load_database(app_module, size)
+    results = []
+
+    def generate_map():
+        with app.test_request_context():
+            app_module.generate_shape_map()
+
+    slow_iterations = max(1, min(iterations, 3))
+    results.append(measure("generate_shape_map", size, generate_map, slow_iterations))
+    results.append(measure("record_page", size, lambda: check_response(client.get("/record_page")), iterations))
+
+    for search in SEARCHES:
+        results.append(measure(f"search_record[{search}]", size,
+                               lambda: check_response(client.post("/search_record", data={"search_this": search})),
+                               iterations))
+
+    customer_ids = [1, size // 2, size]
+    results.append(measure("show_customer", size,
+                           lambda: [check_response(client.post("/show_customer", data={"show_customer_id": i}))
+                                    for i in customer_ids],
+                           iterations))
+
+    # the imports run the same job function the upload page queues, synchronously on a fresh table. customers go
+    # first, emptying them empties the lights that reference them too
+    customers_path, lights_path = synthetic.write_shapefiles(folder, size)
+
+    def clear_table(layer):
+        with app.app_context():
+            app_module.db.session.execute(app_module.text(f"TRUNCATE {layer} RESTART IDENTITY CASCADE"))
+            app_module.db.session.commit()
+
+    def import_shapefile(layer, path):
+        job_id = uuid.uuid4().hex
+        job_folder = os.path.join(folder, job_id)
+        os.makedirs(job_folder)
+        for part in glob.glob(os.path.splitext(path)[0] + ".*"):
+            shutil.copy(part, job_folder)
+
+        with app.app_context():
+            app_module.db.session.add(app_module.ImportJob(id=job_id, layer=layer, mode="append",
+                                                           status="queued", created_at=app_module.datetime.utcnow()))
+            app_module.db.session.commit()
+        app_module.run_import_job(job_id, job_folder, os.path.join(job_folder, os.path.basename(path)),
+                                  layer, "append")
+
+    results.append(measure("upload_import[customers]", size, lambda: import_shapefile("customers", customers_path),
+                           slow_iterations, setup=lambda: clear_table("customers"), rows=size))
+    results.append(measure("upload_import", size, lambda: import_shapefile("lights", lights_path),
+                           slow_iterations, setup=lambda: clear_table("lights"), rows=size))
+    return results
+
+
+# prints how much every benchmark changed against an earlier result file
+def compare(results, previous_path):
+    with open(previous_path, encoding="utf-8") as previous_file:
+        previous = {(result["benchmark"], result["size"]): result for result in json.load(previous_file)["results"]}
+
+    for result in results:
+        before = previous.get((result["benchmark"], result["size"]))
+        if before and before["p50_ms"]:
+            change = (result["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100
+            print(f"{result['benchmark']:>40} {result['size']:>9}  p50 {before['p50_ms']:>10.1f} -> "
+                  f"{result['p50_ms']:>10.1f} ms ({change:+.1f}%)", file=sys.stderr)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "-C", ROOT, "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pycrum against synthetic data.")
+    parser.add_argument("--database-uri", help="use this database instead of starting a local postgres")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--output", help="file to write the json results to, stdout when not given")
+    parser.add_argument("--compare", help="earlier json results to compare against")
+    args = parser.parse_args()
+
+    local_postgres = None
+    database_uri = args.database_uri
+    if database_uri is None:
+        local_postgres = LocalPostgres()
+        database_uri = local_postgres.__enter__()
+
+    try:
+        # the app reads its database from the environment when it is imported
+        os.environ["PYCRUM_DATABASE_URI"] = database_uri
+        import app as app_module
+
+        results = []
+        with tempfile.TemporaryDirectory(prefix="pycrum-bench-files-") as folder:
+            for size in args.sizes:
+                results.extend(run_size(app_module, size, args.iterations, folder))
+    finally:
+        if local_postgres is not None:
+            local_postgres.__exit__(None, None, None)
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "iterations": args.iterations,
+        "results": results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# measures how long a fresh interpreter takes to import the app and how much memory it holds afterwards, the cost
+# every gunicorn worker pays at boot, and what loading the geo stack on first use adds on top of that, e.g.
+#
+#   python benchmarks/startup.py --iterations 10 --output startup.json
+#
+# nothing connects to the database, importing the app only creates its engine
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+
+from run import ROOT, git_revision, percentile
+
+# run in a child interpreter per sample so nothing is already imported. prints the import time, the peak rss after
+# the import, and the same two after touching the geo stack the way the imports, the map and the exports do
+CHILD = """
+import json, resource, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter() - start
+imported_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+heavy = sorted(name for name in ("pandas", "geopandas", "pyproj", "pyogrio", "folium", "pyarrow")
+               if name in sys.modules)
+
+start = time.perf_counter()
+for module in (app.gpd, app.pd, app.np, app.shapely, app.folium, app.pyogrio):
+    module.load()
+geo = time.perf_counter() - start
+geo_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(json.dumps([imported, imported_rss, heavy, geo, geo_rss]))
+"""
+
+
+def sample():
+    output = subprocess.run([sys.executable, "-c", CHILD], cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def summarize(name, values, unit):
+    result = {
+        "benchmark": name,
+        "iterations": len(values),
+        f"mean_{unit}": round(statistics.mean(values), 3),
+        f"p50_{unit}": round(percentile(values, 0.5), 3),
+        f"max_{unit}": round(max(values), 3),
+    }
+    print(f"{name:>24}  p50 {result[f'p50_{unit}']:>10.1f} {unit}", file=sys.stderr)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup time and memory of a pycrum worker.")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--output", help="file to write the json results to, stdout when not given")
+    args = parser.parse_args()
+
+    samples = [sample() for _ in range(args.iterations)]
+    results = [
+        summarize("import_app", [item[0] * 1000 for item in samples], "ms"),
+        summarize("import_app_rss", [item[1] for item in samples], "mb"),
+        summarize("load_geo_stack", [item[3] * 1000 for item in samples], "ms"),
+        summarize("load_geo_stack_rss", [item[4] for item in samples], "mb"),
+    ]
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "iterations": args.iterations,
+        # geo modules found already imported right after importing the app, expected to be empty
+        "imported_at_boot": samples[0][2],
+        "results": results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# synthetic customers and lights for the benchmarks. everything is generated from a seeded random generator so two
+# runs with the same size and seed load exactly the same data
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+# points are spread over a box around birmingham, where the map opens
+CENTER_X = -86.75
+CENTER_Y = 33.45
+SPREAD = 0.5
+AREAS = [f"Area {number}" for number in range(20)]
+JOB_SETS = [f"Job {number}" for number in range(50)]
+STATUSES = ["ON", "OFF", "OUT", "REPAIR", "REMOVED"]
+
+
+def random_points(generator, size, z=False):
+    x = CENTER_X + generator.uniform(-SPREAD, SPREAD, size)
+    y = CENTER_Y + generator.uniform(-SPREAD, SPREAD, size)
+    if z:
+        return shapely.points(x, y, generator.uniform(150, 250, size))
+    return shapely.points(x, y)
+
+
+# customer rows in the shapefile layout read by the upload flow
+def customer_shapefile_frame(size, seed=0):
+    generator = np.random.default_rng(seed)
+    numbers = np.arange(1, size + 1)
+    return gpd.GeoDataFrame({
+        "Customer_N": [f"Customer {number}" for number in numbers],
+        "Service_Ad": [f"{number} Main St" for number in numbers],
+        "Account_Nu": numbers,
+        "Premise_Nu": numbers + 1000000,
+        "Number_Act": generator.integers(0, 20, size),
+        "Number_Ina": generator.integers(0, 5, size),
+        "AREA": generator.choice(AREAS, size),
+        "JOBSET": generator.choice(JOB_SETS, size),
+    }, geometry=random_points(generator, size), crs="EPSG:4326")
+
+
+# light rows in the shapefile layout read by the upload flow, as pointz with an elevation like survey exports
+# usually are, so the imports also go through the z dropping path
+def light_shapefile_frame(size, seed=1):
+    generator = np.random.default_rng(seed)
+    numbers = np.arange(1, size + 1)
+    return gpd.GeoDataFrame({
+        "Title": [f"Light {number}" for number in numbers],
+        "PTAG": numbers,
+        "LR_NUMBER": [f"LR{number}" for number in numbers],
+        "AREA": generator.choice(AREAS, size),
+        "JOBSET": generator.choice(JOB_SETS, size),
+        "Status": generator.choice(STATUSES, size),
+    }, geometry=random_points(generator, size, z=True), crs="EPSG:4326")
+
+
+# writes both shapefiles into folder and returns their paths
+def write_shapefiles(folder, size):
+    customers_path = f"{folder}/customers_{size}.shp"
+    lights_path = f"{folder}/lights_{size}.shp"
+    customer_shapefile_frame(size).to_file(customers_path)
+    light_shapefile_frame(size).to_file(lights_path)
+    return customers_path, lights_path
+
+
+# loads size customers and size lights straight into the database through the app's own copy path, each light is
+# linked to a random customer
+def load_database(app_module, size):
+    app = app_module.app
+    db = app_module.db
+
+    with app.app_context():
+        customers = app_module.shapefile_to_frame(customer_shapefile_frame(size), "customers")
+        app_module.copy_frame("customers", customers)
+        db.session.commit()
+
+        customer_ids = db.session.execute(app_module.text("SELECT id FROM customers")).scalars().all()
+        lights = app_module.shapefile_to_frame(light_shapefile_frame(size), "lights")
+        lights["customer_id"] = pd.Series(np.random.default_rng(2).choice(customer_ids, size), index=lights.index)
+        app_module.copy_frame("lights", lights)
+
+        app_module.record_change("customers")
+        app_module.record_change("lights")
+        db.session.commit()
+        db.session.execute(app_module.text("ANALYZE customers"))
+        db.session.execute(app_module.text("ANALYZE lights"))
+        db.session.commit()
@@ -0,0 +1,15 @@
+# gunicorn settings, read from the working folder when gunicorn starts, e.g. gunicorn app:app
+#
+# the database has to be created or upgraded once per deploy before the workers start:
+#
+#   flask --app app pycrum init-db
+#
+# each worker keeps up to PYCRUM_DB_POOL_SIZE + PYCRUM_DB_MAX_OVERFLOW database connections, keep the number of
+# workers times that under the database's max_connections, or run behind pgbouncer with PYCRUM_PGBOUNCER=1
+
+
+# every worker opens its database connections before it takes its first request
+def post_worker_init(worker):
+    import app
+
+    app.warm_up()